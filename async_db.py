@@ -0,0 +1,196 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import db
+import metrics
+from db import BUY_OK, BUY_OUT_OF_STOCK, BUY_NO_FUNDS
+from db import CONFIRM_OK, CONFIRM_ALREADY, CONFIRM_NOT_FOUND
+from db import STATUS_NEW, STATUS_REVIEW, STATUS_PAID, STATUS_LABELS
+from config import DB_READERS, WRITE_BATCH_WINDOW, WRITE_BATCH_MAX
+
+# Один поток-писатель (SQLite всё равно допускает одного писателя) и небольшой пул читателей.
+# У каждого потока своё долгоживущее соединение из db.get_conn(), в режиме WAL
+# читатели не ждут писателя, а event loop не блокируется ни на чтении, ни на записи.
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+_readers = ThreadPoolExecutor(max_workers=DB_READERS, thread_name_prefix="db-reader")
+
+
+def _timed(func, *args):
+    # Время самого запроса в потоке базы, без ожидания в очереди пула
+    with metrics.timer("db", func.__name__):
+        return func(*args)
+
+
+async def _read(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_readers, _timed, func, *args)
+
+
+async def _write(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_writer, _timed, func, *args)
+
+
+# ========= Групповая запись =========
+# Мелкие частые записи (пользователь, счёт, чек, статус платежа, баланс, FSM) не коммитятся
+# по одной: корутина-сборщик забирает из очереди всё накопившееся (не больше WRITE_BATCH_MAX,
+# при WRITE_BATCH_WINDOW > 0 — ещё и подождав попутные записи) и отдаёт пачку потоку-писателю
+# одной транзакцией (db.write_batch). Пока пачка коммитится, следующие записи копятся в очереди,
+# так что размер пачки сам растёт с нагрузкой.
+# Future каждой записи завершается только после commit (synchronous = FULL — после fsync):
+# вызывающий код, как и раньше, получает результат (id созданного счёта) или свою ошибку,
+# когда запись уже на диске. Один fsync приходится на всю пачку, а не на каждую запись.
+_queue = None
+_batcher = None
+
+
+async def _run_batches(queue):
+    while True:
+        batch = [await queue.get()]
+        if WRITE_BATCH_WINDOW:
+            await asyncio.sleep(WRITE_BATCH_WINDOW)
+        while len(batch) < WRITE_BATCH_MAX and not queue.empty():
+            batch.append(queue.get_nowait())
+        try:
+            results = await _write(db.write_batch, [(name, args) for name, args, _ in batch])
+        except Exception as e:
+            # Не удался сам commit — не зафиксирована ни одна запись пачки
+            results = [(False, e)] * len(batch)
+        for (_, _, future), (ok, value) in zip(batch, results):
+            # Вызывающий мог отмениться, пока пачка коммитилась
+            if future.done():
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+        for _ in batch:
+            queue.task_done()
+
+
+async def _group_write(name, *args):
+    global _queue, _batcher
+    loop = asyncio.get_running_loop()
+    # Сборщик привязан к своему event loop; новый loop (повторный asyncio.run) получает новый
+    if _batcher is None or _batcher.done() or _batcher.get_loop() is not loop:
+        _queue = asyncio.Queue()
+        _batcher = loop.create_task(_run_batches(_queue))
+    future = loop.create_future()
+    _queue.put_nowait((name, args, future))
+    # Время от постановки в очередь до commit — то, что видит обработчик
+    with metrics.timer("db", name):
+        return await future
+
+
+async def flush():
+    # Дождаться commit всех поставленных в очередь записей
+    if _queue is not None and _batcher is not None and not _batcher.done():
+        await _queue.join()
+
+
+def close():
+    # Соединения живут в thread-local и закрываются вместе со своими потоками
+    _writer.shutdown(wait=True)
+    _readers.shutdown(wait=True)
+
+
+# ========= Чтение =========
+async def get_user_ids(after_id, limit):
+    return await _read(db.get_user_ids, after_id, limit)
+
+async def get_admin_ids():
+    return await _read(db.get_admin_ids)
+
+async def get_user_identity(telegram_id):
+    return await _read(db.get_user_identity, telegram_id)
+
+async def get_balance(telegram_id):
+    return await _read(db.get_balance, telegram_id)
+
+async def get_all_products():
+    return await _read(db.get_all_products)
+
+async def get_catalog_version():
+    return await _read(db.get_catalog_version)
+
+async def get_stock_version():
+    return await _read(db.get_stock_version)
+
+async def get_stock():
+    return await _read(db.get_stock)
+
+async def get_stock_alerts(limit):
+    return await _read(db.get_stock_alerts, limit)
+
+async def get_payment(payment_id):
+    return await _read(db.get_payment, payment_id)
+
+async def get_pending_payments_page(per_page, before_id=None, after_id=None):
+    return await _read(db.get_pending_payments_page, per_page, before_id, after_id)
+
+async def count_pending_payments():
+    return await _read(db.count_pending_payments)
+
+async def get_expired_payments(cutoff, limit):
+    return await _read(db.get_expired_payments, cutoff, limit)
+
+async def get_purchases_page(user_telegram_id, limit, before=None, after=None):
+    return await _read(db.get_purchases_page, user_telegram_id, limit, before, after)
+
+async def get_sales_totals(since_day):
+    return await _read(db.get_sales_totals, since_day)
+
+async def get_topup_totals(since_day):
+    return await _read(db.get_topup_totals, since_day)
+
+async def get_top_products(since_day, limit):
+    return await _read(db.get_top_products, since_day, limit)
+
+async def get_sales_rows(after, limit):
+    return await _read(db.get_sales_rows, after, limit)
+
+async def get_payments_rows(after_id, limit):
+    return await _read(db.get_payments_rows, after_id, limit)
+
+async def fsm_get(key):
+    return await _read(db.fsm_get, key)
+
+
+# ========= Запись =========
+async def init_db():
+    return await _write(db.init_db)
+
+async def add_user(telegram_id, referrer=None):
+    return await _group_write("add_user", telegram_id, referrer)
+
+async def set_role(telegram_id, role):
+    return await _write(db.set_role, telegram_id, role)
+
+async def create_payment(user_id, amount, order_name, details):
+    return await _group_write("create_payment", user_id, amount, order_name, details)
+
+async def save_receipt(payment_id, file_url, receipt_sha=None):
+    return await _group_write("save_receipt", payment_id, file_url, receipt_sha)
+
+async def link_receipt(payment_id, receipt_sha):
+    return await _group_write("link_receipt", payment_id, receipt_sha)
+
+async def submit_payment(payment_id, user_id):
+    return await _group_write("submit_payment", payment_id, user_id)
+
+async def confirm_payments(payment_ids):
+    return await _write(db.confirm_payments, payment_ids)
+
+async def delete_stock_alerts(alert_ids):
+    return await _write(db.delete_stock_alerts, alert_ids)
+
+async def delete_payments(payment_ids):
+    return await _write(db.delete_payments, payment_ids)
+
+async def buy_keys(product_id, user_telegram_id, quantity=1):
+    return await _write(db.buy_keys, product_id, user_telegram_id, quantity)
+
+async def fsm_save(key, state, data, updated_at):
+    return await _group_write("fsm_save", key, state, data, updated_at)
+
+async def fsm_delete_expired(cutoff):
+    return await _write(db.fsm_delete_expired, cutoff)
@@ -0,0 +1,256 @@
+# Нагрузочный бенчмарк бота целиком: временная база с N товарами и M ключами,
+# синтетические обновления Telegram (/start, каталог, покупка, пополнение баланса со скриншотом)
+# прогоняются через dp.feed_update с заглушкой вместо Telegram API и локальной папкой вместо Яндекс Диска.
+# Итог — пропускная способность и перцентили задержки по шагам; каждый запуск дописывается
+# в bench_results.jsonl (в .gitignore) и сравнивается с предыдущим запуском с теми же параметрами.
+# Ограничение скорости отправки (outbox.RateLimitMiddleware) по умолчанию в замеры не входит:
+# иначе они покажут лимит Telegram (SEND_RATE сообщений в секунду), а не скорость бота.
+# С --rate-limit оно подключается к заглушке так же, как в main.py.
+# Запуск: python bench.py --users 200 --concurrency 50
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import config
+config.BOT_TOKEN = "123456:bench"
+config.METRICS_PORT = None
+
+import db
+import receipts
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import GetFile, GetMe, SendMessage
+from aiogram.types import (
+    Update,
+    Message,
+    CallbackQuery,
+    User,
+    Chat,
+    PhotoSize,
+    File,
+)
+
+
+def fake_photo():
+    # Каждому пользователю — свой скриншот, иначе все чеки после первого окажутся дубликатами.
+    # С Pillow это настоящий JPEG размером с типичный скриншот, без него — уникальные байты
+    if receipts.Image is None:
+        return b"\xff\xd8" + os.urandom(16) + b"\0" * 50000
+    image = receipts.Image.effect_noise((160, 120), 60).resize((1280, 960)).convert("RGB")
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=90)
+    return out.getvalue()
+
+
+class FakeSession(BaseSession):
+    # Отвечает на запросы к Telegram API сразу (или с заданной задержкой), без сети
+    def __init__(self, latency=0.0, photo=None):
+        super().__init__()
+        self.latency = latency
+        self.photo = photo
+        self.requests = 0
+
+    async def make_request(self, bot, method, timeout=None):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if isinstance(method, SendMessage):
+            return Message(
+                message_id=1, date=datetime.now(), chat=Chat(id=method.chat_id, type="private"), text=method.text
+            )
+        if isinstance(method, GetFile):
+            return File(file_id=method.file_id, file_unique_id=method.file_id, file_path=f"photos/{method.file_id}.jpg")
+        if isinstance(method, GetMe):
+            return User(id=1, is_bot=True, first_name="bench", username="bench_bot")
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield self.photo if self.photo is not None else await asyncio.to_thread(fake_photo)
+
+    async def close(self):
+        pass
+
+
+def seed(products, keys, users):
+    conn = db.get_conn()
+    with conn:
+        conn.executemany(
+            "INSERT INTO products (name, description, price) VALUES (?, ?, ?)",
+            [(f"Товар {i}", f"Описание товара {i}", 100 + i) for i in range(products)]
+        )
+        conn.executemany(
+            "INSERT INTO keys (product_id, key) VALUES (?, ?)",
+            ((i % products + 1, f"KEY-{i:08d}") for i in range(keys))
+        )
+        # Половине пользователей хватает денег на покупку, остальные идут в оплату по счёту
+        conn.executemany("INSERT INTO users (telegram_id) VALUES (?)", [(user_id(i),) for i in range(users)])
+        conn.executemany(
+            "INSERT INTO ledger (user_id, kopecks, kind, created_at) VALUES (?, ?, ?, 0)",
+            [(user_id(i), db.to_kopecks(10000), db.LEDGER_ADJUST) for i in range(0, users, 2)]
+        )
+
+
+def user_id(i):
+    return 100000 + i
+
+
+_update_ids = iter(range(1, 10 ** 9))
+
+
+def message_update(uid, text=None, photo=None):
+    user = User(id=uid, is_bot=False, first_name="user")
+    return Update(update_id=next(_update_ids), message=Message(
+        message_id=1, date=datetime.now(), chat=Chat(id=uid, type="private"), from_user=user,
+        text=text, photo=photo
+    ))
+
+
+def callback_update(uid, data):
+    user = User(id=uid, is_bot=False, first_name="user")
+    message = Message(message_id=1, date=datetime.now(), chat=Chat(id=uid, type="private"), text="...")
+    return Update(update_id=next(_update_ids), callback_query=CallbackQuery(
+        id=str(next(_update_ids)), from_user=user, chat_instance=str(uid), message=message, data=data
+    ))
+
+
+async def user_flow(main, i, products, timings):
+    from callbacks import ProductCb, BuyCb, TopUpCb, ConfirmPaymentCb
+    uid = user_id(i)
+    product_id = i % products + 1
+
+    async def step(name, update):
+        started = time.perf_counter()
+        await main.dp.feed_update(main.bot, update)
+        timings.setdefault(name, []).append(time.perf_counter() - started)
+
+    await step("start", message_update(uid, "/start"))
+    await step("list", message_update(uid, "🛒 Купить ключ"))
+    await step("detail", callback_update(uid, ProductCb(product_id=product_id).pack()))
+    await step("buy", callback_update(uid, BuyCb(product_id=product_id, quantity=1).pack()))
+    await step("balance", message_update(uid, "💰 Баланс"))
+    await step("topup", callback_update(uid, TopUpCb().pack()))
+    await step("amount", message_update(uid, "500"))
+    photo = [PhotoSize(file_id=f"photo{uid}", file_unique_id=f"photo{uid}", width=800, height=600)]
+    await step("photo", message_update(uid, photo=photo))
+    payment_id = db.get_conn().execute("SELECT MAX(id) FROM payments WHERE user_id = ?", (uid,)).fetchone()[0]
+    await step("confirm", callback_update(uid, ConfirmPaymentCb(payment_id=payment_id).pack()))
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def commit_hash():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return None
+
+
+async def run(args):
+    tmp = tempfile.mkdtemp(prefix="bench_")
+    db.DB_PATH = os.path.join(tmp, "bench.db")
+    db.init_db()
+    seed(args.products, args.keys, args.users)
+
+    import main
+    # Построчный лог каждого обновления исказит замеры
+    logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+    import catalog
+    import receipts
+    import metrics
+    import outbox
+    session = FakeSession(args.api_latency / 1000)
+    if args.rate_limit:
+        session.middleware(outbox.RateLimitMiddleware(rate=config.SEND_RATE))
+    session.middleware(metrics.RequestMetricsMiddleware())
+    main.bot.session = session
+    await catalog.reload()
+    receipts.start(receipts.LocalStorage(os.path.join(tmp, "receipts")))
+    metrics.reset()
+
+    timings = {}
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async def limited(i):
+        async with limit:
+            await user_flow(main, i, args.products, timings)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(limited(i) for i in range(args.users)))
+    await receipts.stop()
+    elapsed = time.perf_counter() - started
+
+    total = sum(len(v) for v in timings.values())
+    result = {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "commit": commit_hash(),
+        "params": {
+            "products": args.products, "keys": args.keys, "users": args.users,
+            "concurrency": args.concurrency, "api_latency_ms": args.api_latency, "rate_limit": args.rate_limit,
+        },
+        "updates": total,
+        "seconds": round(elapsed, 3),
+        "throughput": round(total / elapsed, 1),
+        "steps": {
+            name: {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 0.5) * 1000, 3),
+                "p95_ms": round(percentile(values, 0.95) * 1000, 3),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+            }
+            for name, values in timings.items()
+        },
+    }
+    sold = db.get_conn().execute("SELECT COUNT(*) FROM keys WHERE user_id IS NOT NULL").fetchone()[0]
+    result["keys_sold"] = sold
+    return result
+
+
+def load_previous(path, params):
+    if not os.path.exists(path):
+        return None
+    previous = None
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            row = json.loads(line)
+            if row["params"] == params:
+                previous = row
+    return previous
+
+
+def report(result, previous):
+    print(f"обновлений: {result['updates']} за {result['seconds']} с — {result['throughput']} обн/с"
+          + (f" (было {previous['throughput']})" if previous else ""))
+    print(f"продано ключей: {result['keys_sold']}")
+    print(f"{'шаг':10} {'p50, мс':>10} {'p95, мс':>10} {'p99, мс':>10}")
+    for name, s in result["steps"].items():
+        line = f"{name:10} {s['p50_ms']:10.2f} {s['p95_ms']:10.2f} {s['p99_ms']:10.2f}"
+        if previous and name in previous["steps"]:
+            line += f"   (p99 было {previous['steps'][name]['p99_ms']:.2f})"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--products", type=int, default=20)
+    parser.add_argument("--keys", type=int, default=50000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--api-latency", type=float, default=0, help="задержка ответа Telegram API, мс")
+    parser.add_argument("--rate-limit", action="store_true", help="включить ограничение скорости отправки, как в боте")
+    parser.add_argument("--out", default="bench_results.jsonl")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    previous = load_previous(args.out, result["params"])
+    report(result, previous)
+    with open(args.out, "a", encoding="utf-8") as file:
+        file.write(json.dumps(result, ensure_ascii=False) + "\n")
@@ -0,0 +1,136 @@
+# Микро-бенчмарк маршрутизации нажатий inline-кнопок:
+# прежняя цепочка lambda-фильтров против CallbackRouter из callbacks.py.
+# Меряется отдельно сама маршрутизация (выбор обработчика и разбор данных, без middleware)
+# и полный проход через Dispatcher.feed_update с пустыми обработчиками.
+# Запуск: python bench_callbacks.py [итераций]
+import asyncio
+import sys
+import time
+from datetime import datetime
+from aiogram import Bot, Dispatcher, F
+from aiogram.types import Update, CallbackQuery, Message, User, Chat
+from callbacks import (
+    CallbackRouter,
+    ProductCb,
+    BuyCb,
+    CatalogCb,
+    TopUpCb,
+    BalanceCb,
+    ConfirmPaymentCb,
+    PaymentsPageCb,
+)
+
+ITERATIONS = 20000
+
+# Пары (старый формат, новый формат) — по одному нажатию на каждый обработчик
+PRESSES = [
+    ("product_12", ProductCb(product_id=12).pack()),
+    ("buy_confirm_12", BuyCb(product_id=12, quantity=5).pack()),
+    ("add_balance", TopUpCb().pack()),
+    ("confirm_user_payment_345", ConfirmPaymentCb(payment_id=345).pack()),
+    ("back_to_list", CatalogCb().pack()),
+    ("balance_back", BalanceCb().pack()),
+    ("payments_page_3_next_120", PaymentsPageCb(page=3, direction="next", cursor=120).pack()),
+]
+
+
+def legacy_dispatcher():
+    # Та же цепочка фильтров и тот же разбор split("_"), что были в main.py
+    dp = Dispatcher()
+
+    @dp.callback_query(lambda c: c.data and c.data.startswith("product_"))
+    async def show_product_detail(callback):
+        int(callback.data.split("_")[1])
+
+    @dp.callback_query(lambda c: c.data and c.data.startswith("buy_confirm_"))
+    async def show_payment_options(callback):
+        int(callback.data.split("_")[2])
+
+    @dp.callback_query(lambda c: c.data == "add_balance")
+    async def add_balance(callback):
+        pass
+
+    @dp.callback_query(lambda c: c.data and c.data.startswith("confirm_user_payment_"))
+    async def confirm_payment(callback):
+        int(callback.data.split("_")[-1])
+
+    @dp.callback_query(lambda c: c.data == "back_to_list")
+    async def back_to_list(callback):
+        pass
+
+    @dp.callback_query(lambda c: c.data == "balance_back")
+    async def back_to_balance(callback):
+        pass
+
+    @dp.callback_query(lambda c: c.data and c.data.startswith("payments_page_"))
+    async def paginate_payments(callback):
+        _, _, page, direction, cursor = callback.data.split("_")
+        int(page), int(cursor)
+
+    return dp
+
+
+def routed_dispatcher():
+    dp = Dispatcher()
+    router = CallbackRouter()
+    for factory in (ProductCb, BuyCb, TopUpCb, ConfirmPaymentCb, CatalogCb, BalanceCb, PaymentsPageCb):
+        @router.register(factory)
+        async def handler(callback, data):
+            pass
+
+    @dp.callback_query(F.data)
+    async def route_callback(callback):
+        return await router.dispatch(callback)
+
+    return dp
+
+
+def make_update(update_id, data):
+    user = User(id=1, is_bot=False, first_name="bench")
+    message = Message(message_id=1, date=datetime.now(), chat=Chat(id=1, type="private"), from_user=user, text="x")
+    return Update(
+        update_id=update_id,
+        callback_query=CallbackQuery(id=str(update_id), from_user=user, chat_instance="1", message=message, data=data)
+    )
+
+
+async def route(dp, updates):
+    started = time.perf_counter()
+    for update in updates:
+        await dp.callback_query.trigger(update.callback_query)
+    return time.perf_counter() - started
+
+
+async def run(dp, updates, bot):
+    started = time.perf_counter()
+    for update in updates:
+        await dp.feed_update(bot, update)
+    return time.perf_counter() - started
+
+
+async def main(iterations=ITERATIONS):
+    bot = Bot(token="123456:bench")
+    legacy_updates = [make_update(i, PRESSES[i % len(PRESSES)][0]) for i in range(iterations)]
+    routed_updates = [make_update(i, PRESSES[i % len(PRESSES)][1]) for i in range(iterations)]
+    legacy, routed = legacy_dispatcher(), routed_dispatcher()
+
+    # Прогрев
+    await run(legacy, legacy_updates[:500], bot)
+    await run(routed, routed_updates[:500], bot)
+
+    print(f"нажатий: {iterations}")
+    for title, measure in (
+        ("маршрутизация", lambda dp, updates: route(dp, updates)),
+        ("feed_update целиком", lambda dp, updates: run(dp, updates, bot)),
+    ):
+        legacy_time = await measure(legacy, legacy_updates)
+        routed_time = await measure(routed, routed_updates)
+        print(f"{title}:")
+        print(f"  цепочка lambda:  {legacy_time / iterations * 1e6:7.1f} мкс на нажатие")
+        print(f"  CallbackRouter:  {routed_time / iterations * 1e6:7.1f} мкс на нажатие")
+        print(f"  ускорение: x{legacy_time / routed_time:.2f}")
+    await bot.session.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(*map(int, sys.argv[1:2])))
@@ -0,0 +1,76 @@
+# Бенчмарк мелких записей под конкурентной нагрузкой: каждая запись своей транзакцией
+# (как было: отдельный commit на вызов) против групповой записи из async_db.py.
+# Каждый «пользователь» проходит цепочку записей пополнения баланса: add_user, create_payment,
+# fsm_save, submit_payment, save_receipt, update_balance — все одновременно, на свежей базе.
+# База в режиме synchronous = FULL, как у бота: каждый commit — fsync, поэтому базу кладём
+# во временную папку на настоящем диске, а не в tmpfs, иначе fsync ничего не стоит. По умолчанию
+# папка создаётся рядом со скриптом (/tmp часто смонтирован как tmpfs) и удаляется после прогона.
+# Запуск: python bench_writes.py [пользователей] [одновременно] [папка]
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import async_db
+import db
+
+USERS = 2000
+CONCURRENCY = 200
+DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+async def single(name, *args):
+    # Прежний путь: вызов db.<name> в потоке-писателе со своим commit
+    return await async_db._write(getattr(db, name), *args)
+
+
+async def grouped(name, *args):
+    # Тот же вызов через очередь групповой записи
+    return await async_db._group_write(name, *args)
+
+
+async def flow(write, uid):
+    await write("add_user", uid, None)
+    payment_id = await write("create_payment", uid, 500, "Пополнение баланса", "реквизиты")
+    await write("fsm_save", f"1:{uid}:{uid}", "waiting_for_receipt", '{"payment_id": %d}' % payment_id, int(time.time()))
+    await write("submit_payment", payment_id, uid)
+    await write("save_receipt", payment_id, f"https://disk/{payment_id}.jpg")
+    await write("update_balance", uid, 500)
+    return 6
+
+
+async def measure(title, write, users, concurrency, folder):
+    db.DB_PATH = os.path.join(tempfile.mkdtemp(prefix="bench_writes_", dir=folder), "writes.db")
+    await async_db.init_db()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(uid):
+        async with semaphore:
+            return await flow(write, uid)
+
+    started = time.perf_counter()
+    writes = sum(await asyncio.gather(*(one(100000 + i) for i in range(users))))
+    elapsed = time.perf_counter() - started
+
+    conn = db.get_conn()
+    assert conn.execute("SELECT COUNT(*) FROM payments WHERE status = ? AND full_receipt IS NOT NULL",
+                        (db.STATUS_REVIEW,)).fetchone()[0] == users
+    assert conn.execute("SELECT SUM(balance_kopecks) FROM users").fetchone()[0] == db.to_kopecks(500) * users
+    print(f"{title}: {writes / elapsed:8.0f} записей/с ({elapsed:.2f} с на {writes} записей)")
+    return writes / elapsed
+
+
+async def main(users=USERS, concurrency=CONCURRENCY, folder=DIR):
+    print(f"пользователей: {users}, одновременно: {concurrency}, папка: {folder}")
+    with tempfile.TemporaryDirectory(prefix="bench_writes_", dir=folder) as tmp:
+        try:
+            before = await measure("отдельный commit", single, users, concurrency, tmp)
+            after = await measure("групповой commit", grouped, users, concurrency, tmp)
+            print(f"ускорение: x{after / before:.2f}")
+        finally:
+            async_db.close()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    asyncio.run(main(*map(int, args[:2]), *args[2:3]))
@@ -0,0 +1,72 @@
+import inspect
+from aiogram.filters.callback_data import CallbackData
+import metrics
+
+# Компактные callback_data и маршрутизация по префиксу.
+# Вместо цепочки lambda-фильтров, которые aiogram проверяет по очереди для каждого нажатия,
+# в диспетчере зарегистрирован один обработчик: он берёт префикс до ":",
+# находит обработчик в словаре и один раз разбирает данные в типизированный объект.
+
+
+# ========= Фабрики callback_data =========
+class ProductCb(CallbackData, prefix="p"):
+    product_id: int
+
+class BuyCb(CallbackData, prefix="b"):
+    product_id: int
+    quantity: int
+
+class CatalogCb(CallbackData, prefix="c"):
+    pass
+
+class TopUpCb(CallbackData, prefix="t"):
+    pass
+
+class BalanceCb(CallbackData, prefix="bl"):
+    pass
+
+class ConfirmPaymentCb(CallbackData, prefix="cp"):
+    payment_id: int
+
+class PaymentsPageCb(CallbackData, prefix="pp"):
+    page: int
+    direction: str
+    cursor: int
+
+class PurchasesPageCb(CallbackData, prefix="mp"):
+    # Курсор — (purchased_at, id) крайнего ключа на странице
+    page: int
+    direction: str
+    at: int
+    cursor: int
+
+
+# ========= Маршрутизатор =========
+class CallbackRouter:
+    def __init__(self):
+        self._routes = {}
+
+    def register(self, factory):
+        def decorator(handler):
+            params = inspect.signature(handler).parameters
+            # Какие данные aiogram (state и т.п.) нужны обработчику — выясняем один раз при регистрации
+            wanted = tuple(name for name in params if name not in ("callback", "data"))
+            self._routes[factory.__prefix__] = (factory, handler, wanted)
+            return handler
+        return decorator
+
+    async def dispatch(self, callback, **kwargs):
+        prefix = callback.data.split(":", 1)[0]
+        route = self._routes.get(prefix)
+        if route is None:
+            # Кнопка из старого сообщения с прежним форматом данных
+            await callback.answer("Кнопка устарела, откройте меню заново.", show_alert=True)
+            return
+        factory, handler, wanted = route
+        try:
+            data = factory.unpack(callback.data)
+        except (TypeError, ValueError):
+            await callback.answer("Кнопка устарела, откройте меню заново.", show_alert=True)
+            return
+        with metrics.timer("handler", handler.__name__):
+            return await handler(callback, data, **{name: kwargs[name] for name in wanted})
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from async_db import get_all_products, get_catalog_version, get_stock, get_stock_version
+from callbacks import ProductCb, BuyCb, CatalogCb
+from config import CATALOG_POLL_SECONDS, BUY_QUANTITIES
+
+# Каталог в памяти процесса: строки товаров, остатки, готовые тексты карточек и клавиатуры.
+# Меняется только при смене версии в таблице meta, поэтому просмотр каталога
+# вообще не ходит в базу. Остатки версионируются отдельно (stock_version): покупка
+# перечитывает только таблицу stock, а не весь каталог.
+_version = None
+_stock_version = None
+_products = []
+_stock = {}
+_by_id = {}
+_details = {}
+_list_keyboard = None
+
+
+def _detail(product, available):
+    text = (
+        f"🛒 <b>{product[1]}</b>\n\n"
+        f"{product[2] or 'Описание отсутствует.'}\n\n"
+        f"💰 Цена: {product[3]} ₽\n"
+        + (f"📦 В наличии: {available} шт." if available else "❌ Нет в наличии")
+    )
+    # Варианты количества — только те, на которые хватает остатка
+    buy = [
+        InlineKeyboardButton(
+            text="Купить" if quantity == 1 else f"{quantity} шт.",
+            callback_data=BuyCb(product_id=product[0], quantity=quantity).pack()
+        )
+        for quantity in BUY_QUANTITIES if quantity <= available
+    ]
+    back = [InlineKeyboardButton(text="Назад", callback_data=CatalogCb().pack())]
+    return text, InlineKeyboardMarkup(inline_keyboard=[buy, back] if buy else [back])
+
+
+def _label(product, available):
+    return f"{product[1]} — {available} шт." if available else f"{product[1]} — нет в наличии"
+
+
+def _render():
+    global _details, _list_keyboard
+    _details = {p[0]: _detail(p, _stock.get(p[0], 0)) for p in _products}
+    _list_keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=_label(p, _stock.get(p[0], 0)), callback_data=ProductCb(product_id=p[0]).pack())]
+        for p in _products
+    ]) if _products else None
+
+
+async def _reload_stock():
+    global _stock, _stock_version
+    stock_version = await get_stock_version()
+    _stock = await get_stock()
+    _stock_version = stock_version
+
+
+async def reload():
+    global _version, _products, _by_id
+    # Сначала версия, потом строки: если товары поменяются между запросами,
+    # следующая проверка увидит новую версию и перечитает каталог
+    version = await get_catalog_version()
+    products = await get_all_products()
+    await _reload_stock()
+
+    _products = products
+    _by_id = {p[0]: p for p in products}
+    _render()
+    _version = version
+
+
+async def refresh_if_changed():
+    if _version is None or await get_catalog_version() != _version:
+        await reload()
+    elif await get_stock_version() != _stock_version:
+        await _reload_stock()
+        _render()
+
+
+async def watch():
+    while True:
+        try:
+            await refresh_if_changed()
+        except Exception:
+            logging.exception("Не удалось обновить каталог")
+        await asyncio.sleep(CATALOG_POLL_SECONDS)
+
+
+def products():
+    return _products
+
+
+def list_keyboard():
+    return _list_keyboard
+
+
+def get_product(product_id):
+    return _by_id.get(product_id)
+
+
+def get_detail(product_id):
+    return _details.get(product_id)
@@ -0,0 +1,135 @@
+# Проверка планов запросов: каждая функция db.py из горячего пути вызывается на временной базе,
+# все её SQL-запросы перехватываются и прогоняются через EXPLAIN QUERY PLAN.
+# Полный проход по таблице (SCAN) или сортировка во временном B-дереве — ошибка:
+# значит, запросу не хватает индекса и он замедлится вместе с ростом базы.
+# Запуск: python check_query_plans.py  (код возврата 1, если найдены проблемы)
+import os
+import sys
+import tempfile
+import time
+import db
+
+# Полные выборки, которым индекс не нужен по смыслу; stock_alerts — очередь, которую бот
+# опустошает каждые несколько секунд; рейтинг товаров группирует дневные сводки,
+# их размер — дни × товары, а не число продаж; сверка журнала по определению читает его целиком
+FULL_SCAN_OK = {
+    "get_all_products", "get_stock", "get_stock_alerts", "get_top_products",
+    "iter_ledger_totals", "iter_cached_balances",
+}
+
+SKIP = ("BEGIN", "COMMIT", "ROLLBACK", "PRAGMA", "SAVEPOINT", "RELEASE")
+
+
+def seed(conn):
+    conn.execute("INSERT INTO products (name, description, price) VALUES ('p', 'd', 10)")
+    conn.executemany("INSERT INTO keys (product_id, key) VALUES (1, ?)", [(f"KEY-{i}",) for i in range(100)])
+    conn.execute("INSERT INTO users (telegram_id, role) VALUES (1, 'admin')")
+    conn.execute("INSERT INTO users (telegram_id, referrer) VALUES (2, 1)")
+    conn.execute("INSERT INTO ledger (user_id, kopecks, kind, created_at) VALUES (2, 10000000, 'adjust', 0)")
+    conn.executemany(
+        "INSERT INTO payments (user_id, amount, status) VALUES (2, 10, ?)",
+        [(db.STATUS_REVIEW,)] * 20 + [(db.STATUS_PAID,)] * 20
+    )
+    conn.commit()
+
+
+def cases():
+    now = int(time.time())
+    return [
+        ("get_user_identity", lambda: db.get_user_identity(1)),
+        ("add_user", lambda: db.add_user(3, 1)),
+        ("set_role", lambda: db.set_role(3, "user")),
+        ("get_user_ids", lambda: db.get_user_ids(0, 10)),
+        ("get_admin_ids", db.get_admin_ids),
+        ("get_balance", lambda: db.get_balance(2)),
+        ("update_balance", lambda: db.update_balance(2, 1)),
+        ("create_payment", lambda: db.create_payment(2, 10, "o", "d")),
+        ("save_receipt", lambda: db.save_receipt(1, "url")),
+        ("get_payment", lambda: db.get_payment(1)),
+        ("link_receipt", lambda: db.link_receipt(1, "0" * 40)),
+        ("save_receipt", lambda: db.save_receipt(2, "url", "1" * 40)),
+        ("submit_payment", lambda: db.submit_payment(1, 2)),
+        ("confirm_payments", lambda: db.confirm_payments([1, 2, 10 ** 6])),
+        ("get_pending_payments_page", lambda: db.get_pending_payments_page(10)),
+        ("get_pending_payments_page", lambda: db.get_pending_payments_page(10, before_id=15)),
+        ("get_pending_payments_page", lambda: db.get_pending_payments_page(10, after_id=5)),
+        ("count_pending_payments", db.count_pending_payments),
+        ("get_all_products", db.get_all_products),
+        ("get_catalog_version", db.get_catalog_version),
+        ("get_stock_version", db.get_stock_version),
+        ("get_stock", db.get_stock),
+        ("get_stock_alerts", lambda: db.get_stock_alerts(10)),
+        ("delete_stock_alerts", lambda: db.delete_stock_alerts([1, 2])),
+        ("buy_keys", lambda: db.buy_keys(1, 2)),
+        ("buy_keys", lambda: db.buy_keys(1, 2, 5)),
+        ("get_purchases_page", lambda: db.get_purchases_page(2, 10)),
+        ("get_purchases_page", lambda: db.get_purchases_page(2, 10, before=(time.time(), 50))),
+        ("get_purchases_page", lambda: db.get_purchases_page(2, 10, after=(0, 5))),
+        ("get_sales_totals", lambda: db.get_sales_totals("2024-01-01")),
+        ("get_topup_totals", lambda: db.get_topup_totals("2024-01-01")),
+        ("get_top_products", lambda: db.get_top_products("2024-01-01", 5)),
+        ("get_sales_rows", lambda: db.get_sales_rows(("", 0), 10)),
+        ("get_payments_rows", lambda: db.get_payments_rows(0, 10)),
+        ("iter_ledger_totals", lambda: db.iter_ledger_totals(db.get_conn()).fetchall()),
+        ("iter_cached_balances", lambda: db.iter_cached_balances(db.get_conn()).fetchall()),
+        ("rebuild_cached_balances", lambda: db.rebuild_cached_balances([1, 2])),
+        ("fsm_save", lambda: db.fsm_save("k", "s", "{}", now)),
+        ("fsm_get", lambda: db.fsm_get("k")),
+        ("fsm_delete_expired", lambda: db.fsm_delete_expired(now - 10)),
+        ("get_expired_payments", lambda: db.get_expired_payments(now + 10, 10)),
+        ("delete_payments", lambda: db.delete_payments([30, 31])),
+    ]
+
+
+def partial_indexes(conn):
+    names = set()
+    for (table,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall():
+        names.update(row[1] for row in conn.execute(f"PRAGMA index_list({table})") if row[4])
+    return names
+
+
+def problems(conn, sql, partial):
+    found = []
+    for _, _, _, detail in conn.execute("EXPLAIN QUERY PLAN " + sql).fetchall():
+        # Проход по частичному индексу ограничен его условием (например, только админы)
+        if detail.startswith("SCAN ") and detail != "SCAN CONSTANT ROW" and detail.split()[-1] not in partial:
+            found.append(detail)
+        elif "TEMP B-TREE" in detail:
+            found.append(detail)
+    return found
+
+
+def main():
+    tmp = tempfile.mkdtemp()
+    db.DB_PATH = os.path.join(tmp, "plans.db")
+    db.init_db()
+    conn = db.get_conn()
+    seed(conn)
+    partial = partial_indexes(conn)
+
+    captured = []
+    failed = 0
+    checked = 0
+    for name, call in cases():
+        captured.clear()
+        conn.set_trace_callback(captured.append)
+        try:
+            call()
+        finally:
+            conn.set_trace_callback(None)
+        # Триггеры повторяют в трассировке вызвавший их запрос — каждый проверяем один раз
+        for sql in dict.fromkeys(captured):
+            if sql.lstrip().upper().startswith(SKIP):
+                continue
+            checked += 1
+            bad = problems(conn, sql, partial)
+            if bad and name not in FULL_SCAN_OK:
+                failed += 1
+                print(f"FAIL {name}: {' | '.join(bad)}\n     {' '.join(sql.split())}")
+
+    print(f"запросов проверено: {checked}, без индекса: {failed}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
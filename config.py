@@ -1,3 +1,49 @@
 BOT_TOKEN = "TOKEN"
 YANDEX_TOKEN = "TOKEN"
 DB_PATH = "shop.db"
+DB_READERS = 4
+WRITE_BATCH_WINDOW = 0  # секунд ожидания попутных записей; 0 — пачка копится, пока коммитится предыдущая
+WRITE_BATCH_MAX = 500  # записей в одной групповой транзакции
+CATALOG_POLL_SECONDS = 5
+BUY_QUANTITIES = (1, 5, 10, 25)  # варианты количества на карточке товара
+BUY_INLINE_KEYS = 10  # больше ключей за покупку — отправляются файлом .txt
+LOW_STOCK_THRESHOLD = 10  # предупреждать админов, когда ключей товара остаётся столько; 0 — только при обнулении
+UPLOAD_WORKERS = 2
+UPLOAD_QUEUE_SIZE = 100
+UPLOAD_RETRIES = 5
+UPLOAD_BACKOFF = 1
+RECEIPT_MAX_SIDE = 1600  # чек уменьшается до этой длины большей стороны, пикселей
+RECEIPT_QUALITY = 75  # качество JPEG после пережатия
+RETENTION_DAYS = 3
+RETENTION_INTERVAL = 3600
+RETENTION_BATCH = 500
+RETENTION_CONCURRENCY = 8
+IMPORT_CHUNK = 10000
+TOPUP_MAX = 1000000  # наибольшая сумма одного пополнения, ₽ (в копейках она должна влезать в INTEGER SQLite)
+REFERRAL_BONUS = 100
+REFERRAL_THRESHOLD = 2000
+FSM_CACHE_SIZE = 10000
+FSM_TTL = 86400
+FSM_SWEEP_INTERVAL = 600
+# Режим получения обновлений: "polling" или "webhook"
+MODE = "polling"
+WEBHOOK_URL = None  # публичный адрес, например "https://example.com/webhook"; None — не регистрировать вебхук
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8080
+WEBHOOK_SECRET = None
+WEBHOOK_WORKERS = 16
+WEBHOOK_QUEUE_SIZE = 1000
+WEBHOOK_MAX_CONNECTIONS = 40  # соединений Telegram к вебхуку; при PROCESSES > 1 должно быть не меньше PROCESSES
+PROCESSES = 1  # процессов бота в режиме webhook (SO_REUSEPORT, только Linux), см. workers.py
+SEND_RATE = 30
+SEND_BURST = 30
+CHAT_RATE = 1
+CHAT_BURST = 3
+SEND_RETRIES = 3
+BROADCAST_CHUNK = 500
+EXPORT_CHUNK = 5000  # строк за один запрос к базе при выгрузке CSV
+IDENTITY_TTL = 300
+IDENTITY_CACHE_SIZE = 100000
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9100  # None — не поднимать отдельный HTTP-сервер метрик
@@ -1,11 +1,55 @@
-from db import delete_paid_payments
-from config import YANDEX_TOKEN
+import asyncio
+import logging
 import time
-import yadisk
-client = yadisk.Client(token=YANDEX_TOKEN)
-while True:
-    try:
-        delete_paid_payments(client)
-        time.sleep(3600)
-    except Exception as e:
-        print(e)
\ No newline at end of file
+from async_db import get_expired_payments, delete_payments
+from config import RETENTION_DAYS, RETENTION_INTERVAL, RETENTION_BATCH, RETENTION_CONCURRENCY
+from receipts import receipt_name
+
+# Очистка оплаченных платежей старше RETENTION_DAYS: чеки удаляются с диска пачками
+# параллельно (не больше RETENTION_CONCURRENCY запросов сразу), затем строки из базы.
+# Запускается как фоновая задача внутри main.py.
+
+
+async def delete_paid_payments(storage):
+    cutoff = int(time.time()) - RETENTION_DAYS * 24 * 3600
+    limit = asyncio.Semaphore(RETENTION_CONCURRENCY)
+
+    async def remove(payment_id):
+        async with limit:
+            try:
+                await storage.delete(receipt_name(payment_id))
+                return payment_id
+            except Exception:
+                logging.exception("Не удалось удалить чек платежа %s", payment_id)
+
+    deleted = 0
+    while True:
+        payment_ids = await get_expired_payments(cutoff, RETENTION_BATCH)
+        if not payment_ids:
+            break
+        removed = [p for p in await asyncio.gather(*map(remove, payment_ids)) if p is not None]
+        await delete_payments(removed)
+        deleted += len(removed)
+        # Если часть чеков не удалилась, они останутся до следующего запуска
+        if len(removed) < len(payment_ids) or len(payment_ids) < RETENTION_BATCH:
+            break
+    return deleted
+
+
+async def run(storage):
+    while True:
+        try:
+            deleted = await delete_paid_payments(storage)
+            if deleted:
+                logging.info("Удалено оплаченных платежей: %s", deleted)
+        except Exception:
+            logging.exception("Ошибка очистки платежей")
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+
+if __name__ == "__main__":
+    # Разовый запуск вручную
+    import yadisk
+    from config import YANDEX_TOKEN
+    from receipts import YandexDiskStorage
+    print(asyncio.run(delete_paid_payments(YandexDiskStorage(yadisk.Client(token=YANDEX_TOKEN)))))
@@ -1,240 +1,542 @@
 import sqlite3
+import threading
 import time
-from datetime import datetime, timedelta
-from config import DB_PATH
+import migrations
+from config import DB_PATH, REFERRAL_BONUS, REFERRAL_THRESHOLD, LOW_STOCK_THRESHOLD
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+# Долгоживущие соединения: по одному на поток и на файл базы.
+# Пул потоков в async_db.py переиспользует их, поэтому connect() не попадает в горячий путь.
+_local = threading.local()
 
-    c.execute('''CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        telegram_id INTEGER UNIQUE,
-        balance REAL DEFAULT 0,
-        referrer INTEGER,
-        role TEXT DEFAULT 'user',
-        referral_bonus_given INTEGER DEFAULT 0
-    )''')
-
-    c.execute('''CREATE TABLE IF NOT EXISTS products (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT UNIQUE NOT NULL,
-        description TEXT,
-        price INTEGER NOT NULL
-    )''')
-
-    c.execute('''CREATE TABLE IF NOT EXISTS keys (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        product_id INTEGER NOT NULL,
-        key TEXT UNIQUE NOT NULL,
-        user_id INTEGER
-    )''')
-
-    c.execute('''CREATE TABLE IF NOT EXISTS payments (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        amount REAL,
-        payment_id TEXT,
-        status TEXT DEFAULT 'на рассмотрении',
-        order_name TEXT,
-        details TEXT,
-        full_receipt TEXT,
-        data TEXT
-    )''')
-
-    conn.commit()
-    conn.close()
-
-def is_admin(telegram_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT role FROM users WHERE telegram_id = ?", (telegram_id,))
-    row = c.fetchone()
-    conn.close()
-    return row and row[0] == "admin"
+def _connect(path):
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("PRAGMA journal_mode = WAL")
+    # FULL: commit возвращается только после fsync журнала WAL — подтверждённая запись
+    # переживает и падение процесса, и отключение питания. Цену fsync на мелких записях
+    # делит на пачку групповая запись (async_db.py); читатели не коммитят и fsync не платят.
+    conn.execute("PRAGMA synchronous = FULL")
+    conn.execute("PRAGMA busy_timeout = 30000")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -16000")
+    conn.execute("PRAGMA mmap_size = 134217728")
+    return conn
 
-def get_pending_payments():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+def get_conn():
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+    conn = conns.get(DB_PATH)
+    if conn is None:
+        conn = conns[DB_PATH] = _connect(DB_PATH)
+    return conn
+
+# Коды статусов платежа
+STATUS_NEW = "new"          # счёт создан
+STATUS_REVIEW = "review"    # пользователь прислал чек, ждёт администратора
+STATUS_PAID = "paid"        # оплата подтверждена
+STATUS_LABELS = {
+    STATUS_NEW: "создан",
+    STATUS_REVIEW: "на рассмотрении",
+    STATUS_PAID: "оплачено",
+}
+
+# Виды записей журнала баланса (ledger); ref — id платежа, товара или приглашённого покупателя
+LEDGER_OPENING = "opening"     # баланс, перенесённый при переходе на журнал
+LEDGER_TOPUP = "topup"         # подтверждённое пополнение, ref — id платежа
+LEDGER_PURCHASE = "purchase"   # покупка ключей, ref — id товара
+LEDGER_REFERRAL = "referral"   # реферальный бонус, ref — telegram_id приглашённого
+LEDGER_ADJUST = "adjust"       # ручное изменение (update_balance)
+
+def to_kopecks(amount):
+    # Суммы в рублях (payments.amount, products.price) переводятся в копейки только здесь
+    return int(round(amount * 100))
+
+def _ledger_entry(c, telegram_id, kopecks, kind, ref=None):
+    # Запись в журнал; баланс в users обновляет триггер ledger_balance тем же запросом.
+    # Для несуществующего пользователя ничего не пишется, как и раньше с UPDATE users.
     c.execute("""
-        SELECT id, user_id, amount, order_name, status, full_receipt
-        FROM payments
-        WHERE status = 'На рассмотрении'
-        ORDER BY id DESC
-    """)
-    rows = c.fetchall()
-    conn.close()
-    return rows
+        INSERT INTO ledger (user_id, kopecks, kind, ref, created_at)
+        SELECT telegram_id, ?, ?, ?, ? FROM users WHERE telegram_id = ?
+    """, (kopecks, kind, ref, int(time.time()), telegram_id))
+    return c.rowcount
 
-def get_all_payments():
-    conn = sqlite3.connect(DB_PATH)
+def init_db():
+    conn = get_conn()
+    migrations.migrate(conn)
+    # Порог читает триггер stock_low, поэтому он хранится в базе
+    with conn:
+        conn.execute("UPDATE meta SET value = ? WHERE name = 'low_stock_threshold'", (LOW_STOCK_THRESHOLD,))
+
+def get_pending_payments_page(per_page, before_id=None, after_id=None):
+    # Keyset-пагинация по id: «вперёд» — id меньше последнего показанного,
+    # «назад» — id больше первого показанного. Читается не больше per_page строк.
+    conn = get_conn()
     c = conn.cursor()
+    if after_id is not None:
+        c.execute("""
+            SELECT id, user_id, amount, order_name, status, full_receipt, duplicate_of
+            FROM payments
+            WHERE status = ? AND id > ?
+            ORDER BY id ASC
+            LIMIT ?
+        """, (STATUS_REVIEW, after_id, per_page))
+        return c.fetchall()[::-1]
+    if before_id is not None:
+        c.execute("""
+            SELECT id, user_id, amount, order_name, status, full_receipt, duplicate_of
+            FROM payments
+            WHERE status = ? AND id < ?
+            ORDER BY id DESC
+            LIMIT ?
+        """, (STATUS_REVIEW, before_id, per_page))
+        return c.fetchall()
     c.execute("""
-        SELECT id, user_id, amount, order_name, status, full_receipt, data
+        SELECT id, user_id, amount, order_name, status, full_receipt, duplicate_of
         FROM payments
+        WHERE status = ?
         ORDER BY id DESC
-    """)
-    rows = c.fetchall()
-    conn.close()
-    return rows
+        LIMIT ?
+    """, (STATUS_REVIEW, per_page))
+    return c.fetchall()
+
+def count_pending_payments():
+    conn = get_conn()
+    row = conn.execute("SELECT value FROM meta WHERE name = 'pending_payments'").fetchone()
+    return row[0] if row else 0
+
+def _add_user(conn, telegram_id, referrer=None):
+    if referrer == telegram_id:
+        referrer = None
+    conn.execute(
+        "INSERT OR IGNORE INTO users (telegram_id, referrer) VALUES (?, ?)", (telegram_id, referrer)
+    )
 
 def add_user(telegram_id, referrer=None):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT id FROM users WHERE telegram_id = ?", (telegram_id,))
-    if c.fetchone() is None:
-        c.execute(
-            "INSERT INTO users (telegram_id, referrer) VALUES (?, ?)", (telegram_id, referrer)
-        )
-    conn.commit()
-    conn.close()
+    conn = get_conn()
+    with conn:
+        _add_user(conn, telegram_id, referrer)
+
+def get_user_identity(telegram_id):
+    conn = get_conn()
+    return conn.execute("SELECT id, role FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
+
+def set_role(telegram_id, role):
+    conn = get_conn()
+    with conn:
+        conn.execute("UPDATE users SET role = ? WHERE telegram_id = ?", (role, telegram_id))
+
+def get_admin_ids():
+    conn = get_conn()
+    return [row[0] for row in conn.execute("SELECT telegram_id FROM users WHERE role = 'admin'")]
+
+def get_user_ids(after_id, limit):
+    # Получатели рассылки порциями по id, без загрузки всей таблицы
+    conn = get_conn()
+    return conn.execute(
+        "SELECT id, telegram_id FROM users WHERE id > ? ORDER BY id LIMIT ?", (after_id, limit)
+    ).fetchall()
 
 def get_balance(telegram_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_conn()
     c = conn.cursor()
-    c.execute("SELECT balance FROM users WHERE telegram_id = ?", (telegram_id,))
+    c.execute("SELECT balance_kopecks FROM users WHERE telegram_id = ?", (telegram_id,))
     row = c.fetchone()
-    conn.close()
     if row:
-        return float(row[0])
+        return row[0] / 100
     return 0.0
 
+def _update_balance(conn, telegram_id, amount):
+    _ledger_entry(conn.cursor(), telegram_id, to_kopecks(amount), LEDGER_ADJUST)
+
 def update_balance(telegram_id, amount):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("UPDATE users SET balance = balance + ? WHERE telegram_id = ?", (amount, telegram_id))
-    conn.commit()
-    conn.close()
+    conn = get_conn()
+    with conn:
+        _update_balance(conn, telegram_id, amount)
 
-def create_payment(user_id, amount, order_name, details):
-    conn = sqlite3.connect(DB_PATH)
+def _create_payment(conn, user_id, amount, order_name, details):
     c = conn.cursor()
     c.execute('''INSERT INTO payments (user_id, amount, order_name, details) VALUES (?, ?, ?, ?)''',
               (user_id, amount, order_name, details))
-    conn.commit()
-    payment_id = c.lastrowid
-    conn.close()
-    return payment_id
+    return c.lastrowid
 
-def save_receipt(payment_id, file_url):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("UPDATE payments SET full_receipt = ? WHERE id = ?", (file_url, payment_id))
-    conn.commit()
-    conn.close()
+def create_payment(user_id, amount, order_name, details):
+    conn = get_conn()
+    with conn:
+        return _create_payment(conn, user_id, amount, order_name, details)
+
+# Хэш чека записывается только вместе со ссылкой на загруженный файл: чек, который
+# не удалось загрузить, не станет «оригиналом» для следующих.
+def _link_receipt(conn, payment_id, receipt_sha):
+    # Побайтно тот же чек уже загружен — платёж получает ссылку на тот же файл.
+    # Возвращает id исходного платежа или None, если такого чека ещё нет (тогда ничего не пишется).
+    original = conn.execute(
+        "SELECT id, full_receipt FROM payments WHERE receipt_sha = ? AND id != ? ORDER BY id LIMIT 1",
+        (receipt_sha, payment_id)
+    ).fetchone()
+    if original is None:
+        return None
+    conn.execute(
+        "UPDATE payments SET full_receipt = ?, receipt_sha = ?, duplicate_of = ? WHERE id = ?",
+        (original[1], receipt_sha, original[0], payment_id)
+    )
+    return original[0]
+
+def link_receipt(payment_id, receipt_sha):
+    conn = get_conn()
+    with conn:
+        return _link_receipt(conn, payment_id, receipt_sha)
+
+def _save_receipt(conn, payment_id, file_url, receipt_sha=None):
+    # Новый файл чека. Если побайтно тот же чек одновременно загрузили для более раннего
+    # платежа, этот платёж помечается для админа. Возвращает id того платежа или None.
+    duplicate_of = None
+    if receipt_sha is not None:
+        row = conn.execute(
+            "SELECT id FROM payments WHERE receipt_sha = ? AND id != ? ORDER BY id LIMIT 1",
+            (receipt_sha, payment_id)
+        ).fetchone()
+        duplicate_of = row[0] if row else None
+    conn.execute(
+        "UPDATE payments SET full_receipt = ?, receipt_sha = ?, duplicate_of = ? WHERE id = ?",
+        (file_url, receipt_sha, duplicate_of, payment_id)
+    )
+    return duplicate_of
+
+def save_receipt(payment_id, file_url, receipt_sha=None):
+    conn = get_conn()
+    with conn:
+        return _save_receipt(conn, payment_id, file_url, receipt_sha)
 
 def get_payment(payment_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT * FROM payments WHERE id = ?", (payment_id,))
-    payment = c.fetchone()
-    conn.close()
-    return payment
+    conn = get_conn()
+    return conn.execute("SELECT * FROM payments WHERE id = ?", (payment_id,)).fetchone()
 
-def set_payment_status(payment_id, status):
-    
+def _submit_payment(conn, payment_id, user_id):
+    # Пользователь отправляет на проверку только свой и только что созданный счёт:
+    # повторное нажатие кнопки не вернёт оплаченный платёж в review, иначе следующий
+    # /confirm зачислил бы его второй раз. Возвращает True, если статус изменён.
     a = time.localtime()
     b = str(a.tm_mday) + "." + str(a.tm_mon) + "." + str(a.tm_year)
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("UPDATE payments SET status = ? WHERE id = ?", (status, payment_id))
-    c.execute("UPDATE payments SET data = ? WHERE id = ?", (b, payment_id))
-    conn.commit()
-    conn.close()
+    c = conn.execute(
+        "UPDATE payments SET status = ?, data = ? WHERE id = ? AND user_id = ? AND status = ?",
+        (STATUS_REVIEW, b, payment_id, user_id, STATUS_NEW)
+    )
+    return c.rowcount == 1
 
-def get_all_products():
-    conn = sqlite3.connect(DB_PATH)
-    products = conn.execute("SELECT id, name, description, price FROM products").fetchall()
-    conn.close()
-    return products
-
-def get_product_by_id(product_id):
-    conn = sqlite3.connect(DB_PATH)
-    product = conn.execute("SELECT id, name, description, price FROM products WHERE id = ?", (product_id,)).fetchone()
-    conn.close()
-    return product
-
-def buy_key_by_product_id(product_id, user_telegram_id):
-    conn = sqlite3.connect(DB_PATH)
+def submit_payment(payment_id, user_id):
+    conn = get_conn()
+    with conn:
+        return _submit_payment(conn, payment_id, user_id)
+
+# Результаты подтверждения платежа
+CONFIRM_OK = "ok"
+CONFIRM_ALREADY = "already"
+CONFIRM_NOT_FOUND = "not_found"
+
+def confirm_payments(payment_ids):
+    # Все подтверждения — одна транзакция и один commit. Уже оплаченный платёж
+    # не проходит условие UPDATE, поэтому повторное подтверждение не пополняет баланс дважды.
+    a = time.localtime()
+    b = str(a.tm_mday) + "." + str(a.tm_mon) + "." + str(a.tm_year)
+    now = int(time.time())
+    conn = get_conn()
     c = conn.cursor()
-    c.execute("SELECT id, key FROM keys WHERE product_id = ? AND user_id IS NULL LIMIT 1", (product_id,))
-    row = c.fetchone()
-    if row:
-        key_id, key_value = row
-        c.execute("SELECT balance FROM users WHERE telegram_id = ?", (user_telegram_id,))
-        user_balance_row = c.fetchone()
-        c.execute("SELECT price FROM products WHERE id = ?", (product_id,))
-        price = c.fetchone()[0]
-        if not user_balance_row or user_balance_row[0] < price:
-            conn.close()
-            return None
-        c.execute("UPDATE users SET balance = balance - ? WHERE telegram_id = ?", (price, user_telegram_id))
-        c.execute("UPDATE keys SET user_id = ? WHERE id = ?", (user_telegram_id, key_id))
+    results = []
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        for payment_id in payment_ids:
+            c.execute("""
+                UPDATE payments SET status = ?, paid_at = ?, data = ?
+                WHERE id = ? AND status IS NOT ?
+                RETURNING user_id, amount
+            """, (STATUS_PAID, now, b, payment_id, STATUS_PAID))
+            row = c.fetchone()
+            if row:
+                user_id, amount = row
+                _ledger_entry(c, user_id, to_kopecks(amount), LEDGER_TOPUP, payment_id)
+                results.append((payment_id, CONFIRM_OK, user_id, amount))
+                continue
+            c.execute("SELECT user_id, amount FROM payments WHERE id = ?", (payment_id,))
+            row = c.fetchone()
+            if row:
+                results.append((payment_id, CONFIRM_ALREADY, row[0], row[1]))
+            else:
+                results.append((payment_id, CONFIRM_NOT_FOUND, None, None))
         conn.commit()
-        conn.close()
-        return key_value
-    conn.close()
-    return None
+    except:
+        conn.rollback()
+        raise
+    return results
+
+def get_all_products():
+    conn = get_conn()
+    return conn.execute("SELECT id, name, description, price FROM products").fetchall()
+
+def get_catalog_version():
+    conn = get_conn()
+    row = conn.execute("SELECT value FROM meta WHERE name = 'catalog_version'").fetchone()
+    return row[0] if row else 0
+
+def get_stock_version():
+    conn = get_conn()
+    row = conn.execute("SELECT value FROM meta WHERE name = 'stock_version'").fetchone()
+    return row[0] if row else 0
+
+def get_stock():
+    # Остатки всех товаров — одна строка на товар, ведутся триггерами на keys
+    conn = get_conn()
+    return dict(conn.execute("SELECT product_id, available FROM stock").fetchall())
+
+def get_stock_alerts(limit):
+    conn = get_conn()
+    return conn.execute(
+        "SELECT id, product_id, available FROM stock_alerts ORDER BY id LIMIT ?", (limit,)
+    ).fetchall()
 
-def check_and_grant_referral_bonus(user_telegram_id):
-    BONUS_SUM = 100
-    REFERRAL_THRESHOLD = 2000
+def delete_stock_alerts(alert_ids):
+    conn = get_conn()
+    with conn:
+        conn.executemany("DELETE FROM stock_alerts WHERE id = ?", [(alert_id,) for alert_id in alert_ids])
 
-    conn = sqlite3.connect(DB_PATH)
+# Результаты покупки
+BUY_OK = "ok"
+BUY_OUT_OF_STOCK = "out_of_stock"
+BUY_NO_FUNDS = "no_funds"
+
+def buy_keys(product_id, user_telegram_id, quantity=1):
+    # BEGIN IMMEDIATE сразу берёт блокировку записи: между выбором ключей и списанием
+    # никто (ни другой поток, ни другой процесс) не успеет продать те же ключи.
+    # Ключи выдаются все или ни одного: если свободных меньше quantity, покупки нет.
+    if quantity < 1:
+        raise ValueError(f"quantity must be positive: {quantity}")
+    conn = get_conn()
     c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        c.execute("""
+            UPDATE keys SET user_id = ?, purchased_at = ?
+            WHERE id IN (SELECT id FROM keys WHERE product_id = ? AND user_id IS NULL LIMIT ?)
+            RETURNING key
+        """, (user_telegram_id, int(time.time()), product_id, quantity))
+        keys = [row[0] for row in c.fetchall()]
+        if len(keys) < quantity:
+            conn.rollback()
+            return BUY_OUT_OF_STOCK, []
 
-    c.execute("SELECT id, referrer, referral_bonus_given FROM users WHERE telegram_id = ?", (user_telegram_id,))
-    user_data = c.fetchone()
-    if not user_data:
-        conn.close()
-        return
-    user_id, referrer_id, bonus_given = user_data
+        # Списание — запись в журнал, только если хватает баланса; кэш в users обновит триггер
+        c.execute("""
+            INSERT INTO ledger (user_id, kopecks, kind, ref, created_at)
+            SELECT u.telegram_id, -CAST(ROUND(? * p.price * 100) AS INTEGER), ?, p.id, ?
+            FROM users u, products p
+            WHERE u.telegram_id = ? AND p.id = ? AND u.balance_kopecks >= CAST(ROUND(? * p.price * 100) AS INTEGER)
+        """, (quantity, LEDGER_PURCHASE, int(time.time()), user_telegram_id, product_id, quantity))
+        if c.rowcount == 0:
+            conn.rollback()
+            return BUY_NO_FUNDS, []
+        c.execute("""
+            UPDATE users SET total_spent = total_spent + ? * (SELECT price FROM products WHERE id = ?)
+            WHERE telegram_id = ?
+            RETURNING total_spent, referrer, referral_bonus_given
+        """, (quantity, product_id, user_telegram_id))
+        _grant_referral_bonus(c, user_telegram_id, *c.fetchone())
 
-    if referrer_id is None or bonus_given:
-        conn.close()
+        conn.commit()
+        return BUY_OK, keys
+    except:
+        conn.rollback()
+        raise
+
+def _grant_referral_bonus(c, user_telegram_id, total_spent, referrer, bonus_given):
+    # Вызывается внутри транзакции покупки: бонус начисляется тем же commit,
+    # которым покупатель перешёл порог. Флаг ставится покупателю, чтобы
+    # за одного приглашённого бонус выдавался один раз.
+    if referrer is None or referrer == user_telegram_id or bonus_given or total_spent < REFERRAL_THRESHOLD:
         return
+    c.execute("UPDATE users SET referral_bonus_given = 1 WHERE telegram_id = ?", (user_telegram_id,))
+    _ledger_entry(c, referrer, to_kopecks(REFERRAL_BONUS), LEDGER_REFERRAL, user_telegram_id)
 
-    c.execute("""
-        SELECT SUM(p.price) FROM keys k
-        JOIN products p ON k.product_id = p.id
+def get_purchases_page(user_telegram_id, limit, before=None, after=None):
+    # Keyset-пагинация по (purchased_at, id), новые сверху: «вперёд» — старше последнего
+    # показанного ключа, «назад» — новее первого. Индекс idx_keys_user отдаёт строки уже по порядку.
+    conn = get_conn()
+    if after is not None:
+        rows = conn.execute("""
+            SELECT k.id, k.key, k.purchased_at, p.name
+            FROM keys k LEFT JOIN products p ON p.id = k.product_id
+            WHERE k.user_id = ? AND (k.purchased_at, k.id) > (?, ?)
+            ORDER BY k.purchased_at, k.id
+            LIMIT ?
+        """, (user_telegram_id, *after, limit)).fetchall()
+        return rows[::-1]
+    if before is not None:
+        return conn.execute("""
+            SELECT k.id, k.key, k.purchased_at, p.name
+            FROM keys k LEFT JOIN products p ON p.id = k.product_id
+            WHERE k.user_id = ? AND (k.purchased_at, k.id) < (?, ?)
+            ORDER BY k.purchased_at DESC, k.id DESC
+            LIMIT ?
+        """, (user_telegram_id, *before, limit)).fetchall()
+    return conn.execute("""
+        SELECT k.id, k.key, k.purchased_at, p.name
+        FROM keys k LEFT JOIN products p ON p.id = k.product_id
         WHERE k.user_id = ?
-    """, (user_id,))
-    total_sum = c.fetchone()[0] or 0
-
-    if total_sum >= REFERRAL_THRESHOLD:
-        c.execute("SELECT telegram_id FROM users WHERE id = ?", (referrer_id,))
-        referrer_telegram = c.fetchone()
-        if referrer_telegram:
-            c.execute(
-                "UPDATE users SET balance = balance + ?, referral_bonus_given = 1 WHERE id = ?",
-                (BONUS_SUM, referrer_id)
-            )
-            conn.commit()
-    conn.close()
-
-def disk_delete(client, payment_id):
-    file_path = f"/yadisk/payment_{payment_id}.jpg"
-    # Ищем файл по имени
-    client.remove(file_path)
-    
-def delete_paid_payments(client):
-    to_delete=[]
-    payments = get_all_payments()
-    for payment in payments:
-        date_format = '%d.%m.%Y'
-        if payment[6] is None:
-            continue
-        given_date = datetime.strptime(payment[6], date_format)
-        current_date = datetime.now()
-        diff = current_date - given_date
-        if payment[4] == 'Оплачено' and diff > timedelta(days=3):
-            disk_delete(client, payment[0])
-            to_delete.append(payment[0])
-              
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    c.execute("DELETE FROM payments WHERE id IN ({})".format(','.join(['?']*len(to_delete))), to_delete)
-    conn.commit()
-    conn.close()
-    return 
\ No newline at end of file
+        ORDER BY k.purchased_at DESC, k.id DESC
+        LIMIT ?
+    """, (user_telegram_id, limit)).fetchall()
+
+# ========= Отчёты =========
+def get_sales_totals(since_day):
+    # Итоги из дневных сводок; since_day — 'YYYY-MM-DD', '' — за всё время
+    conn = get_conn()
+    return conn.execute(
+        "SELECT COALESCE(SUM(sold), 0), COALESCE(SUM(revenue), 0) FROM sales_daily WHERE day >= ?", (since_day,)
+    ).fetchone()
+
+def get_topup_totals(since_day):
+    conn = get_conn()
+    return conn.execute(
+        "SELECT COALESCE(SUM(confirmed), 0), COALESCE(SUM(amount), 0) FROM payments_daily WHERE day >= ?", (since_day,)
+    ).fetchone()
+
+def get_top_products(since_day, limit):
+    conn = get_conn()
+    return conn.execute("""
+        SELECT s.product_id, p.name, SUM(s.sold), SUM(s.revenue)
+        FROM sales_daily s LEFT JOIN products p ON p.id = s.product_id
+        WHERE s.day >= ?
+        GROUP BY s.product_id
+        ORDER BY SUM(s.revenue) DESC
+        LIMIT ?
+    """, (since_day, limit)).fetchall()
+
+def get_sales_rows(after, limit):
+    # Выгрузка сводки порциями по ключу (day, product_id)
+    conn = get_conn()
+    return conn.execute("""
+        SELECT s.day, s.product_id, p.name, s.sold, s.revenue
+        FROM sales_daily s LEFT JOIN products p ON p.id = s.product_id
+        WHERE (s.day, s.product_id) > (?, ?)
+        ORDER BY s.day, s.product_id
+        LIMIT ?
+    """, (*after, limit)).fetchall()
+
+def get_payments_rows(after_id, limit):
+    conn = get_conn()
+    return conn.execute("""
+        SELECT id, user_id, amount, status, order_name, paid_at
+        FROM payments
+        WHERE id > ?
+        ORDER BY id
+        LIMIT ?
+    """, (after_id, limit)).fetchall()
+
+# ========= FSM =========
+def fsm_get(key):
+    conn = get_conn()
+    return conn.execute("SELECT state, data, updated_at FROM fsm WHERE key = ?", (key,)).fetchone()
+
+def _fsm_save(conn, key, state, data, updated_at):
+    # Пустая запись (нет ни состояния, ни данных) не хранится
+    if state is None and data is None:
+        conn.execute("DELETE FROM fsm WHERE key = ?", (key,))
+    else:
+        conn.execute("""
+            INSERT INTO fsm (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET state = excluded.state, data = excluded.data,
+                                            updated_at = excluded.updated_at
+        """, (key, state, data, updated_at))
+
+def fsm_save(key, state, data, updated_at):
+    conn = get_conn()
+    with conn:
+        _fsm_save(conn, key, state, data, updated_at)
+
+def fsm_delete_expired(cutoff):
+    conn = get_conn()
+    with conn:
+        return conn.execute("DELETE FROM fsm WHERE updated_at < ?", (cutoff,)).rowcount
+
+def get_expired_payments(cutoff, limit):
+    # Платёж, чей файл чека использует дубликат (та же ссылка), ждёт, пока удалят дубликат
+    conn = get_conn()
+    rows = conn.execute("""
+        SELECT id FROM payments p
+        WHERE status = ? AND paid_at < ?
+          AND NOT EXISTS (
+              SELECT 1 FROM payments d WHERE d.duplicate_of = p.id AND d.full_receipt = p.full_receipt
+          )
+        ORDER BY paid_at
+        LIMIT ?
+    """, (STATUS_PAID, cutoff, limit)).fetchall()
+    return [row[0] for row in rows]
+
+def delete_payments(payment_ids):
+    conn = get_conn()
+    with conn:
+        conn.executemany("DELETE FROM payments WHERE id = ?", [(payment_id,) for payment_id in payment_ids])
+
+
+# ========= Сверка журнала =========
+# Оба потока упорядочены по telegram_id и идут по индексам без сортировки в памяти:
+# сверка сливает их за один проход (см. reconcile_ledger.py)
+def iter_ledger_totals(conn):
+    return conn.execute("SELECT user_id, SUM(kopecks) FROM ledger GROUP BY user_id ORDER BY user_id")
+
+def iter_cached_balances(conn):
+    return conn.execute(
+        "SELECT telegram_id, balance_kopecks FROM users WHERE telegram_id IS NOT NULL ORDER BY telegram_id"
+    )
+
+def rebuild_cached_balances(telegram_ids):
+    # Пересчёт кэша из журнала для указанных пользователей; сумма берётся заново внутри транзакции
+    conn = get_conn()
+    with conn:
+        conn.executemany("""
+            UPDATE users SET balance_kopecks = COALESCE((SELECT SUM(kopecks) FROM ledger WHERE user_id = ?), 0)
+            WHERE telegram_id = ?
+        """, [(telegram_id, telegram_id) for telegram_id in telegram_ids])
+
+
+# ========= Групповая запись =========
+# Мелкие записи выше разделены на тело (_add_user и т.д. — выполняется на переданном соединении
+# без commit) и обёртку с собственной транзакцией. async_db собирает тела, пришедшие почти
+# одновременно, и выполняет их здесь одной транзакцией с одним commit.
+GROUP_WRITES = {
+    "add_user": _add_user,
+    "update_balance": _update_balance,
+    "create_payment": _create_payment,
+    "save_receipt": _save_receipt,
+    "link_receipt": _link_receipt,
+    "submit_payment": _submit_payment,
+    "fsm_save": _fsm_save,
+}
+
+def write_batch(ops):
+    # ops — список (имя, аргументы). Каждая запись — в своём SAVEPOINT: ошибка одной
+    # откатывает только её, остальные всё равно фиксируются.
+    # Возвращает список (True, результат) или (False, исключение) в порядке ops.
+    conn = get_conn()
+    if len(ops) == 1:
+        # Одиночная запись (нагрузки нет) — обычная транзакция, без накладных расходов SAVEPOINT
+        name, args = ops[0]
+        try:
+            with conn:
+                return [(True, GROUP_WRITES[name](conn, *args))]
+        except Exception as e:
+            return [(False, e)]
+    results = []
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for name, args in ops:
+            conn.execute("SAVEPOINT write")
+            try:
+                results.append((True, GROUP_WRITES[name](conn, *args)))
+            except Exception as e:
+                conn.execute("ROLLBACK TO write")
+                results.append((False, e))
+            conn.execute("RELEASE write")
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    return results
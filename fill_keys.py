@@ -1,23 +1,21 @@
-import sqlite3
-from config import DB_PATH
+from config import IMPORT_CHUNK
+from importer import import_csv, parse_args
 
-def fill_keys():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
 
-    with open("data/keys.csv", "r", encoding="utf-8") as file:
-        file.readline()
-        keys = []
-        for line in file:
-            p = line.strip().split("|")
-            keys.append((int(p[0]), p[1],))
+def parse_key(p):
+    product_id, key = int(p[0]), p[1].strip()
+    if not key:
+        raise ValueError("пустой ключ")
+    return product_id, key
 
-    c.executemany(
+
+def fill_keys(path="data/keys.csv", chunk_size=IMPORT_CHUNK, drop_indexes=False, restart=False):
+    return import_csv(
+        path, "keys",
         "INSERT OR IGNORE INTO keys (product_id, key, user_id) VALUES (?, ?, NULL)",
-        keys
+        parse_key, chunk_size, drop_indexes, restart
     )
-    conn.commit()
-    conn.close()
     
 if __name__ == "__main__":
-    fill_keys()
+    args = parse_args("data/keys.csv")
+    fill_keys(args.path, args.chunk, args.drop_indexes, args.restart)
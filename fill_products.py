@@ -1,23 +1,21 @@
-import sqlite3
-from config import DB_PATH
+from config import IMPORT_CHUNK
+from importer import import_csv, parse_args
 
-def fill_products():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
 
-    with open("data/products.csv", "r", encoding="utf-8") as file:
-        file.readline()  # Пропускаем заголовок
-        products = []
-        for line in file:
-            p = line.strip().split("|")
-            products.append((p[0], p[1], int(p[2])))
+def parse_product(p):
+    name, description, price = p[0].strip(), p[1], int(p[2])
+    if not name:
+        raise ValueError("пустое название")
+    return name, description, price
 
-    c.executemany(
+
+def fill_products(path="data/products.csv", chunk_size=IMPORT_CHUNK, drop_indexes=False, restart=False):
+    return import_csv(
+        path, "products",
         "INSERT OR IGNORE INTO products (name, description, price) VALUES (?, ?, ?)",
-        products
+        parse_product, chunk_size, drop_indexes, restart
     )
-    conn.commit()
-    conn.close()
 
 if __name__ == "__main__":
-    fill_products()
\ No newline at end of file
+    args = parse_args("data/products.csv")
+    fill_products(args.path, args.chunk, args.drop_indexes, args.restart)
@@ -0,0 +1,96 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+from async_db import fsm_get, fsm_save, fsm_delete_expired
+from config import FSM_CACHE_SIZE, FSM_TTL, FSM_SWEEP_INTERVAL
+
+# Хранилище FSM в той же SQLite-базе (таблица fsm) с LRU-кэшем в памяти.
+# Запись идёт сразу и в кэш, и в базу; чтение берёт данные из кэша,
+# в базу ходит только при первом обращении к ключу после запуска или вытеснения.
+# Пустые записи тоже кэшируются, поэтому пользователи без состояния базу не трогают.
+# Фоновая чистка удаляет сессии, к которым не обращались дольше FSM_TTL.
+
+
+def _key(key):
+    return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id}:{key.business_connection_id}:{key.destiny}"
+
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, cache_size=FSM_CACHE_SIZE, ttl=FSM_TTL):
+        self.cache_size = cache_size
+        self.ttl = ttl
+        # ключ -> [state, data, updated_at]
+        self._cache = OrderedDict()
+
+    async def _load(self, key):
+        record = self._cache.get(key)
+        if record is not None:
+            self._cache.move_to_end(key)
+            return record
+        row = await fsm_get(key)
+        if row is None:
+            record = [None, {}, 0]
+        else:
+            record = [row[0], json.loads(row[1]) if row[1] else {}, row[2]]
+        return self._remember(key, record)
+
+    def _remember(self, key, record):
+        # Пока ждали базу, запись могла появиться в кэше — она свежее
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        self._put(key, record)
+        return record
+
+    def _put(self, key, record):
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _save(self, key, record):
+        record[2] = int(time.time())
+        self._put(key, record)
+        data = json.dumps(record[1], ensure_ascii=False) if record[1] else None
+        await fsm_save(key, record[0], data, record[2])
+
+    async def set_state(self, key, state=None):
+        k = _key(key)
+        record = list(await self._load(k))
+        record[0] = state.state if isinstance(state, State) else state
+        await self._save(k, record)
+
+    async def get_state(self, key):
+        return (await self._load(_key(key)))[0]
+
+    async def set_data(self, key, data):
+        k = _key(key)
+        record = list(await self._load(k))
+        record[1] = dict(data)
+        await self._save(k, record)
+
+    async def get_data(self, key):
+        return dict((await self._load(_key(key)))[1])
+
+    async def sweep(self):
+        cutoff = int(time.time()) - self.ttl
+        for k in [k for k, record in self._cache.items() if record[2] and record[2] < cutoff]:
+            del self._cache[k]
+        return await fsm_delete_expired(cutoff)
+
+    async def run_sweeper(self, interval=FSM_SWEEP_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                expired = await self.sweep()
+                if expired:
+                    logging.info("Удалено устаревших FSM-сессий: %s", expired)
+            except Exception:
+                logging.exception("Ошибка очистки FSM-сессий")
+
+    async def close(self):
+        self._cache.clear()
@@ -0,0 +1,48 @@
+import time
+from collections import OrderedDict
+import async_db
+from config import IDENTITY_TTL, IDENTITY_CACHE_SIZE
+
+# Кэш «кто это»: внутренний id и роль пользователя по telegram_id.
+# /start, /payments, /confirm и пагинация у знакомых пользователей не делают запросов к базе.
+# Запись живёт IDENTITY_TTL секунд (так подхватываются правки роли напрямую в базе),
+# смена роли через set_role сбрасывает её сразу. Незнакомые пользователи тоже кэшируются.
+
+# telegram_id -> (истекает, (id, role) или None)
+_cache = OrderedDict()
+
+
+async def get(telegram_id):
+    entry = _cache.get(telegram_id)
+    if entry is not None and entry[0] > time.monotonic():
+        _cache.move_to_end(telegram_id)
+        return entry[1]
+    identity = await async_db.get_user_identity(telegram_id)
+    _cache[telegram_id] = (time.monotonic() + IDENTITY_TTL, identity)
+    _cache.move_to_end(telegram_id)
+    while len(_cache) > IDENTITY_CACHE_SIZE:
+        _cache.popitem(last=False)
+    return identity
+
+
+def invalidate(telegram_id):
+    _cache.pop(telegram_id, None)
+
+
+async def is_admin(telegram_id):
+    identity = await get(telegram_id)
+    return identity is not None and identity[1] == "admin"
+
+
+async def ensure_user(telegram_id, referrer=None):
+    if await get(telegram_id) is not None:
+        return
+    if referrer == telegram_id:
+        referrer = None
+    await async_db.add_user(telegram_id, referrer)
+    invalidate(telegram_id)
+
+
+async def set_role(telegram_id, role):
+    await async_db.set_role(telegram_id, role)
+    invalidate(telegram_id)
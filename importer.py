@@ -0,0 +1,146 @@
+import argparse
+import os
+import time
+import db
+from config import IMPORT_CHUNK
+
+# Потоковый импорт CSV (разделитель «|», первая строка — заголовок):
+# файл читается построчно, строки пишутся пачками по chunk_size в отдельных транзакциях,
+# номер последней записанной строки хранится в meta в той же транзакции,
+# поэтому прерванный импорт продолжается с места остановки.
+# С --drop-indexes SQL снятых индексов тоже хранится в meta (той же транзакцией, что и DROP),
+# и индексы возвращаются в конце импорта или при следующем запуске, если импорт был прерван
+# вплоть до kill -9 или отключения питания.
+
+
+def read_rows(path, parse, skip=0):
+    # Отдаёт (номер строки, значения или None, текст ошибки)
+    with open(path, "r", encoding="utf-8") as file:
+        file.readline()
+        for lineno, line in enumerate(file, start=2):
+            if lineno <= skip:
+                continue
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield lineno, parse(line.split("|")), None
+            except (ValueError, IndexError) as e:
+                yield lineno, None, f"{e}: {line}"
+
+
+def _progress_name(table, path):
+    return f"import:{table}:{os.path.abspath(path)}"
+
+
+def _dropped_prefix(table):
+    return f"dropped_index:{table}:"
+
+
+def _drop_indexes(conn, table):
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        rows = c.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+            (table,)
+        ).fetchall()
+        for name, sql in rows:
+            c.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (_dropped_prefix(table) + name, sql))
+            c.execute(f"DROP INDEX {name}")
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    return len(rows)
+
+
+def _restore_indexes(conn, table):
+    # Пересоздание индекса и удаление его записи из meta — одна транзакция
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        rows = c.execute(
+            "SELECT name, value FROM meta WHERE substr(name, 1, ?) = ?",
+            (len(_dropped_prefix(table)), _dropped_prefix(table))
+        ).fetchall()
+        for name, sql in rows:
+            c.execute(sql)
+            c.execute("DELETE FROM meta WHERE name = ?", (name,))
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    return len(rows)
+
+
+def import_csv(path, table, insert_sql, parse, chunk_size=IMPORT_CHUNK, drop_indexes=False, restart=False):
+    db.init_db()
+    conn = db.get_conn()
+    c = conn.cursor()
+    progress = _progress_name(table, path)
+
+    if restart:
+        with conn:
+            c.execute("DELETE FROM meta WHERE name = ?", (progress,))
+    row = c.execute("SELECT value FROM meta WHERE name = ?", (progress,)).fetchone()
+    skip = row[0] if row else 0
+    if skip:
+        print(f"Продолжаем импорт {path} со строки {skip + 1}")
+
+    # Индексы, которые снял прерванный запуск, возвращаются до всего остального
+    if _restore_indexes(conn, table):
+        print(f"Восстановлены индексы {table}, снятые прерванным импортом")
+    dropped = _drop_indexes(conn, table) if drop_indexes else 0
+
+    report_path = path + ".report.txt"
+    inserted = duplicates = invalid = 0
+    started = time.monotonic()
+    try:
+        with open(report_path, "a" if skip else "w", encoding="utf-8") as report:
+            chunk = 0
+            c.execute("BEGIN")
+            for lineno, values, error in read_rows(path, parse, skip):
+                if error is not None:
+                    invalid += 1
+                    report.write(f"строка {lineno}: ошибка: {error}\n")
+                else:
+                    c.execute(insert_sql, values)
+                    if c.rowcount:
+                        inserted += 1
+                    else:
+                        duplicates += 1
+                        report.write(f"строка {lineno}: дубликат: {'|'.join(map(str, values))}\n")
+                chunk += 1
+                if chunk >= chunk_size:
+                    c.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (progress, lineno))
+                    conn.commit()
+                    elapsed = time.monotonic() - started
+                    print(f"{lineno - 1} строк, добавлено {inserted}, {(inserted + duplicates + invalid) / elapsed:.0f} строк/с")
+                    chunk = 0
+                    c.execute("BEGIN")
+            # Файл дочитан — прогресс больше не нужен
+            c.execute("DELETE FROM meta WHERE name = ?", (progress,))
+            conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        if dropped:
+            _restore_indexes(conn, table)
+
+    elapsed = time.monotonic() - started
+    print(
+        f"Готово за {elapsed:.1f} с: добавлено {inserted}, дубликатов {duplicates}, ошибок {invalid}. "
+        f"Отчёт: {report_path}"
+    )
+    return inserted, duplicates, invalid
+
+
+def parse_args(default_path):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", nargs="?", default=default_path)
+    parser.add_argument("--chunk", type=int, default=IMPORT_CHUNK, help="строк в одной транзакции")
+    parser.add_argument("--drop-indexes", action="store_true", help="снять индексы на время загрузки")
+    parser.add_argument("--restart", action="store_true", help="начать заново, забыв сохранённый прогресс")
+    return parser.parse_args()
@@ -1,7 +1,8 @@
+import html
 import logging
-import os
 import yadisk
 import asyncio
+import time
 from math import ceil
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
@@ -13,24 +14,56 @@ from aiogram.types import (
     ReplyKeyboardMarkup,
     KeyboardButton,
     CallbackQuery,
-    Message
+    Message,
+    BufferedInputFile
 )
-from config import BOT_TOKEN, YANDEX_TOKEN
-from db import (
+from config import BOT_TOKEN, YANDEX_TOKEN, REFERRAL_BONUS, REFERRAL_THRESHOLD, MODE, BROADCAST_CHUNK
+from config import METRICS_HOST, METRICS_PORT, PROCESSES, SEND_RATE, SEND_BURST, FSM_CACHE_SIZE, CATALOG_POLL_SECONDS
+from config import BUY_QUANTITIES, BUY_INLINE_KEYS, TOPUP_MAX
+import catalog
+import identity
+import metrics
+from fsm_storage import SQLiteStorage
+from callbacks import (
+    CallbackRouter,
+    ProductCb,
+    BuyCb,
+    CatalogCb,
+    TopUpCb,
+    BalanceCb,
+    ConfirmPaymentCb,
+    PaymentsPageCb,
+    PurchasesPageCb,
+)
+import cron
+import outbox
+import receipts
+import reports
+import webhook
+import workers
+from async_db import (
     init_db,
-    add_user,
-    get_all_products,
-    get_product_by_id,
-    buy_key_by_product_id,
+    buy_keys,
     create_payment,
     get_payment,
-    set_payment_status,
+    submit_payment,
+    confirm_payments,
+    CONFIRM_OK,
+    CONFIRM_ALREADY,
     get_balance,
-    save_receipt,
-    update_balance,
-    check_and_grant_referral_bonus,
-    get_pending_payments,
-    is_admin,
+    get_pending_payments_page,
+    count_pending_payments,
+    get_user_ids,
+    get_admin_ids,
+    get_purchases_page,
+    get_stock_alerts,
+    delete_stock_alerts,
+    flush as flush_db,
+    close as close_db,
+    BUY_OK,
+    BUY_OUT_OF_STOCK,
+    STATUS_PAID,
+    STATUS_LABELS,
 )
 
 
@@ -41,18 +74,35 @@ class PaymentStates(StatesGroup):
 
 logging.basicConfig(level=logging.INFO)
 
+# Несколько процессов бывает только в режиме webhook (см. workers.py): лимит отправки
+# Telegram общий на всех, а кэшу FSM в памяти процесса верить нельзя — следующее
+# сообщение пользователя может обработать другой процесс
+processes = PROCESSES if MODE == "webhook" else 1
+
 bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
+# Общий лимит Telegram делится между процессами — и скорость, и допустимый всплеск
+bot.session.middleware(outbox.RateLimitMiddleware(rate=SEND_RATE / processes, burst=max(1, SEND_BURST / processes)))
+bot.session.middleware(metrics.RequestMetricsMiddleware())
+fsm_storage = SQLiteStorage(cache_size=FSM_CACHE_SIZE if processes == 1 else 0)
+dp = Dispatcher(storage=fsm_storage)
+# Обработчики нажатий замеряет сам callback_router
+dp.message.middleware(metrics.HandlerMetricsMiddleware())
+
 
+callback_router = CallbackRouter()
 
 client = yadisk.Client(token=YANDEX_TOKEN)
+storage = receipts.YandexDiskStorage(client)
 
     
 
 # ========= Константы =========
+PAYMENTS_PER_PAGE = 10
+PURCHASES_PER_PAGE = 10
+
 MAIN_MENU = ReplyKeyboardMarkup(
     keyboard=[
-        [KeyboardButton(text="🛒 Купить ключ")],
+        [KeyboardButton(text="🛒 Купить ключ"), KeyboardButton(text="📦 Мои покупки")],
         [KeyboardButton(text="💰 Баланс"), KeyboardButton(text="👥 Рефералы")]
     ],
     resize_keyboard=True
@@ -63,7 +113,10 @@ MAIN_MENU = ReplyKeyboardMarkup(
 async def start(msg: types.Message):
     args = msg.text.split()
     ref = int(args[1]) if len(args) > 1 and args[1].isdigit() else None
-    add_user(msg.from_user.id, ref)
+    # Пригласить самого себя нельзя
+    if ref == msg.from_user.id:
+        ref = None
+    await identity.ensure_user(msg.from_user.id, ref)
 
     await msg.answer(
         "👋 Привет! Это магазин ключей.\n\n"
@@ -75,26 +128,21 @@ async def start(msg: types.Message):
 @dp.message(F.text == "💰 Баланс")
 @dp.message(Command("balance"))
 async def show_balance(msg: types.Message):
-    balance = get_balance(msg.from_user.id)
+    balance = await get_balance(msg.from_user.id)
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Пополнить баланс", callback_data="add_balance")]
+        [InlineKeyboardButton(text="Пополнить баланс", callback_data=TopUpCb().pack())]
     ])
     await msg.answer(f"💰 Ваш текущий баланс: {balance} ₽", reply_markup=keyboard)
 
 @dp.message(F.text == "🛒 Купить ключ")
 @dp.message(Command("buy"))
 async def list_products(msg: types.Message):
-    products = get_all_products()
-    if not products:
+    if not catalog.products():
         await msg.answer("❌ Нет доступных товаров для покупки.", reply_markup=MAIN_MENU)
         return
 
     text = "🛍️ Доступные товары:"
-    buttons = [
-        [InlineKeyboardButton(text=p[1], callback_data=f"product_{p[0]}")] for p in products
-    ]
-    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-    await msg.answer(text, reply_markup=keyboard)
+    await msg.answer(text, reply_markup=catalog.list_keyboard())
 
 @dp.message(F.text == "👥 Рефералы")
 @dp.message(Command("ref"))
@@ -103,61 +151,112 @@ async def show_ref_link(msg: types.Message):
     link = f"https://t.me/{(await bot.me()).username}?start={user_id}"
     await msg.answer(
         f"👥 Ваша реферальная ссылка:\n\n{link}\n\n"
-        "Приглашайте друзей — получите бонус 100 ₽, если они купят товаров на 2000 ₽.",
+        f"Приглашайте друзей — получите бонус {REFERRAL_BONUS} ₽, если они купят товаров на {REFERRAL_THRESHOLD} ₽.",
         reply_markup=MAIN_MENU
     )
 
+# ========= Мои покупки =========
+@dp.message(F.text == "📦 Мои покупки")
+@dp.message(Command("purchases"))
+async def list_purchases(msg: types.Message):
+    # Берём на одну строку больше страницы — так видно, есть ли следующая
+    purchases = await get_purchases_page(msg.from_user.id, PURCHASES_PER_PAGE + 1)
+    if not purchases:
+        await msg.answer("📦 У вас пока нет покупок.", reply_markup=MAIN_MENU)
+        return
+    text, keyboard = render_purchases_page(purchases[:PURCHASES_PER_PAGE], 1, len(purchases) > PURCHASES_PER_PAGE)
+    await msg.answer(text, parse_mode="HTML", reply_markup=keyboard)
+
+
+@callback_router.register(PurchasesPageCb)
+async def paginate_purchases(callback: CallbackQuery, data: PurchasesPageCb):
+    user_id = callback.from_user.id
+    cursor = (data.at, data.cursor)
+    if data.direction == "next":
+        purchases = await get_purchases_page(user_id, PURCHASES_PER_PAGE + 1, before=cursor)
+        has_next = len(purchases) > PURCHASES_PER_PAGE
+        purchases = purchases[:PURCHASES_PER_PAGE]
+    else:
+        purchases = await get_purchases_page(user_id, PURCHASES_PER_PAGE, after=cursor)
+        has_next = True
+    if not purchases:
+        await callback.answer("📦 Больше покупок нет.", show_alert=True)
+        return
+    text, keyboard = render_purchases_page(purchases, data.page, has_next)
+    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
+    await callback.answer()
+
+
+def render_purchases_page(purchases, page, has_next):
+    text_lines = ["📦 <b>Мои покупки</b>"]
+    for _, key, purchased_at, name in purchases:
+        date = time.strftime("%d.%m.%Y", time.localtime(purchased_at)) if purchased_at else "дата неизвестна"
+        text_lines.append(f"\n🛒 {html.escape(name or 'Товар удалён')} — {date}\n<code>{html.escape(key)}</code>")
+    text_lines.append(f"\n📄 Страница {page}")
+
+    first, last = purchases[0], purchases[-1]
+    buttons = []
+    if page > 1:
+        buttons.append(InlineKeyboardButton(text="⬅️ Новее", callback_data=PurchasesPageCb(
+            page=page - 1, direction="prev", at=first[2], cursor=first[0]).pack()))
+    if has_next:
+        buttons.append(InlineKeyboardButton(text="➡️ Старше", callback_data=PurchasesPageCb(
+            page=page + 1, direction="next", at=last[2], cursor=last[0]).pack()))
+    return "\n".join(text_lines), InlineKeyboardMarkup(inline_keyboard=[buttons] if buttons else [])
+
+# ========= Inline-кнопки =========
+@dp.callback_query(F.data)
+async def route_callback(callback: CallbackQuery, state: FSMContext):
+    return await callback_router.dispatch(callback, state=state)
+
 # ========= Просмотр товара =========
-@dp.callback_query(lambda c: c.data and c.data.startswith("product_"))
-async def show_product_detail(callback: CallbackQuery):
-    product_id = int(callback.data.split("_")[1])
-    product = get_product_by_id(product_id)
-    if not product:
+@callback_router.register(ProductCb)
+async def show_product_detail(callback: CallbackQuery, data: ProductCb):
+    product_id = data.product_id
+    detail = catalog.get_detail(product_id)
+    if not detail:
         await callback.answer("Товар не найден.", show_alert=True)
         return
 
-    text = (
-        f"🛒 <b>{product[1]}</b>\n\n"
-        f"{product[2] or 'Описание отсутствует.'}\n\n"
-        f"💰 Цена: {product[3]} ₽"
-    )
-
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Купить", callback_data=f"buy_confirm_{product[0]}"),
-         InlineKeyboardButton(text="Назад", callback_data="back_to_list")]
-    ])
+    text, keyboard = detail
     await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
     await callback.answer()
 
 # ========= Покупка =========
-@dp.callback_query(lambda c: c.data and c.data.startswith("buy_confirm_"))
-async def show_payment_options(callback: CallbackQuery):
-    product_id = int(callback.data.split("_")[2])
-    product = get_product_by_id(product_id)
+@callback_router.register(BuyCb)
+async def show_payment_options(callback: CallbackQuery, data: BuyCb):
+    product_id = data.product_id
+    product = catalog.get_product(product_id)
     if not product:
         await callback.answer("Товар не найден.", show_alert=True)
         return
 
+    # Количество приходит из callback_data: принимаем только значения с кнопок каталога
+    quantity = data.quantity
+    if quantity not in BUY_QUANTITIES:
+        await callback.answer("Кнопка устарела, откройте каталог заново.", show_alert=True)
+        return
+
     user_id = callback.from_user.id
-    balance = get_balance(user_id)
-    price = product[3]
-
-    # Если хватает баланса
-    if balance >= price:
-        key = buy_key_by_product_id(product_id, user_id)
-        if key:
-            check_and_grant_referral_bonus(user_id)
-            await callback.message.edit_text(
-                f"✅ Покупка успешна!\nВаш ключ:\n<code>{key}</code>",
-                parse_mode="HTML"
-            )
-            await bot.send_message(
-                callback.from_user.id,
-                "Главное меню 👇",
-                reply_markup=MAIN_MENU
-            )
-        else:
-            await callback.message.edit_text("❌ Ключей для этого товара больше нет.")
+
+    # Ключи, списание и реферальный бонус — одной транзакцией
+    status, keys = await buy_keys(product_id, user_id, quantity)
+    if status == BUY_OK:
+        # Ключи уже оплачены — доставляем их вне очереди рассылок
+        with outbox.lane(outbox.HIGH):
+            if len(keys) > BUY_INLINE_KEYS:
+                # Длинный список не влезет в сообщение — отправляем файлом
+                await callback.message.edit_text(f"✅ Покупка успешна! Ключей: {len(keys)}, список — в файле ниже.")
+                await bot.send_document(
+                    callback.from_user.id,
+                    BufferedInputFile("\n".join(keys).encode(), filename=f"keys_{product_id}.txt")
+                )
+            else:
+                await callback.message.edit_text(
+                    ("✅ Покупка успешна!\nВаш ключ:\n" if len(keys) == 1 else "✅ Покупка успешна!\nВаши ключи:\n")
+                    + "\n".join(f"<code>{key}</code>" for key in keys),
+                    parse_mode="HTML"
+                )
             await bot.send_message(
                 callback.from_user.id,
                 "Главное меню 👇",
@@ -165,6 +264,18 @@ async def show_payment_options(callback: CallbackQuery):
             )
         await callback.answer()
         return
+    if status == BUY_OUT_OF_STOCK:
+        await callback.message.edit_text(
+            "❌ Ключей для этого товара больше нет." if quantity == 1
+            else f"❌ Недостаточно ключей для покупки {quantity} шт."
+        )
+        await bot.send_message(
+            callback.from_user.id,
+            "Главное меню 👇",
+            reply_markup=MAIN_MENU
+        )
+        await callback.answer()
+        return
 
     # Иначе — создаём счёт
     payment_details = (
@@ -174,9 +285,9 @@ async def show_payment_options(callback: CallbackQuery):
         "👤 Получатель: Тестовый Получатель\n\n"
         "Отправьте квитанцию после оплаты, проверка до 2 часов."
     )
-    amount = product[3]
-    order_name = product[1]
-    payment_id = create_payment(user_id, amount, order_name, payment_details)
+    amount = product[3] * quantity
+    order_name = product[1] if quantity == 1 else f"{product[1]} × {quantity}"
+    payment_id = await create_payment(user_id, amount, order_name, payment_details)
 
     text = (
         f"💳 Оплата товара <b>{order_name}</b>\n\n"
@@ -186,14 +297,14 @@ async def show_payment_options(callback: CallbackQuery):
         f"{payment_details}"
     )
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Подтвердить оплату", callback_data=f"confirm_payment_{payment_id}")],
-        [InlineKeyboardButton(text="↩️ Назад", callback_data="back_to_list")]
+        [InlineKeyboardButton(text="✅ Подтвердить оплату", callback_data=ConfirmPaymentCb(payment_id=payment_id).pack())],
+        [InlineKeyboardButton(text="↩️ Назад", callback_data=CatalogCb().pack())]
     ])
     await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data == "add_balance")
-async def add_balance(callback: CallbackQuery, state: FSMContext):
+@callback_router.register(TopUpCb)
+async def add_balance(callback: CallbackQuery, data: TopUpCb, state: FSMContext):
     await callback.message.edit_text("💳 Введите сумму пополнения (от 100 ₽):")
     await callback.answer()
     await state.set_state(PaymentStates.waiting_for_amount)
@@ -204,6 +315,9 @@ async def handle_balance_input(msg: Message, state: FSMContext):
     if amount < 100:
         await msg.answer("❌ Сумма должна быть от 100 ₽.")
         return
+    if amount > TOPUP_MAX:
+        await msg.answer(f"❌ Сумма должна быть не больше {TOPUP_MAX} ₽.")
+        return
 
     payment_details = (
             "Реквизиты для оплаты:\n"
@@ -213,7 +327,7 @@ async def handle_balance_input(msg: Message, state: FSMContext):
         )
 
     user_id = msg.from_user.id
-    payment_id = create_payment(user_id, amount, "Пополнение баланса", payment_details)
+    payment_id = await create_payment(user_id, amount, "Пополнение баланса", payment_details)
 
     await msg.answer(
         f"💰 Пополнение баланса\n\n"
@@ -238,45 +352,36 @@ async def get_photo(msg: Message, state: FSMContext):
     file = await msg.bot.get_file(msg.photo[-1].file_id)
     img_bytes = await msg.bot.download_file(file.file_path)
 
-    image_data = img_bytes.read()
-
-    try:
-        file_name = f"payment_{payment_id}.jpg"
-        file_path = f"/yadisk/{file_name}"
-        with open(file_name, "wb") as f:
-            f.write(image_data)
-        client.upload(file_name, file_path)
-        b = client.publish(file_path)
-        link = b.get_meta(file_path)
-        os.remove(file_name)
-    except:
-        await msg.answer("Не удалось загрузить скриншот, отправьте скриншот в поддержку")
-        return
-    save_receipt(payment_id, link.public_url)
+    # Загрузка на диск идёт в фоне, пользователь получает ответ сразу
+    await receipts.submit(payment_id, img_bytes.read(), msg.chat.id)
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Подтвердить оплату", callback_data=f"confirm_user_payment_{payment_id}")],
-        [InlineKeyboardButton(text="↩️ Назад", callback_data="balance_back")]
+        [InlineKeyboardButton(text="✅ Подтвердить оплату", callback_data=ConfirmPaymentCb(payment_id=payment_id).pack())],
+        [InlineKeyboardButton(text="↩️ Назад", callback_data=BalanceCb().pack())]
     ])
 
     await msg.answer(
-        "✅ Фото получено и загружено!\nТеперь нажмите подтверждение 👇",
+        "✅ Фото получено!\nТеперь нажмите подтверждение 👇",
         reply_markup=keyboard
     )
 
     await state.clear()
             
 # ========= Подтверждение оплаты =========
-@dp.callback_query(lambda c: c.data and c.data.startswith("confirm_user_payment_"))
-async def confirm_payment(callback: CallbackQuery):
-    payment_id = int(callback.data.split("_")[-1])
-    payment = get_payment(payment_id)
-    if not payment:
-        await callback.answer("Платёж не найден.", show_alert=True)
+@callback_router.register(ConfirmPaymentCb)
+async def confirm_payment(callback: CallbackQuery, data: ConfirmPaymentCb):
+    payment_id = data.payment_id
+    if not await submit_payment(payment_id, callback.from_user.id):
+        # Чужой, уже отправленный или уже оплаченный счёт — статус не меняем
+        payment = await get_payment(payment_id)
+        if not payment or payment[1] != callback.from_user.id:
+            await callback.answer("Платёж не найден.", show_alert=True)
+        elif payment[4] == STATUS_PAID:
+            await callback.answer("Этот платёж уже подтверждён.", show_alert=True)
+        else:
+            await callback.answer("Заявка уже на рассмотрении.", show_alert=True)
         return
 
-    set_payment_status(payment_id, "На рассмотрении")
-
     await callback.message.edit_text(
         "✅ Ваша заявка на рассмотрении.\n"
         "Ожидайте подтверждения администратора."
@@ -291,93 +396,216 @@ async def confirm_payment(callback: CallbackQuery):
 # ========= Подтверждение платежа администратором =========
 @dp.message(Command("confirm"))
 async def admin_confirm_payment(msg: types.Message):
-    if not is_admin(msg.from_user.id):
+    if not await identity.is_admin(msg.from_user.id):
         await msg.answer("❌ Только администратор может подтверждать платежи.")
         return
     args = msg.text.split()
-    if len(args) < 2 or not args[1].isdigit():
-        await msg.answer("⚠️ Использование: /confirm <payment_id>")
+    if len(args) < 2 or not all(a.isdigit() for a in args[1:]):
+        await msg.answer("⚠️ Использование: /confirm <payment_id> [payment_id ...]")
+        return
+
+    results = await confirm_payments([int(a) for a in args[1:]])
+
+    lines = []
+    credited = {}
+    for payment_id, result, user_id, amount in results:
+        if result == CONFIRM_OK:
+            lines.append(f"✅ №{payment_id}: баланс пользователя {user_id} пополнен на {amount} ₽")
+            credited.setdefault(user_id, []).append((payment_id, amount))
+        elif result == CONFIRM_ALREADY:
+            lines.append(f"⚠️ №{payment_id}: уже подтверждён ранее")
+        else:
+            lines.append(f"❌ №{payment_id}: платёж не найден")
+
+    # Одна сводка администратору
+    await answer_lines(msg, lines)
+
+    # И по одному уведомлению каждому пользователю, сколько бы платежей у него ни подтвердили
+    with outbox.lane(outbox.HIGH):
+        await asyncio.gather(*(
+            notify_payments_confirmed(user_id, payments) for user_id, payments in credited.items()
+        ))
+
+
+async def answer_lines(msg, lines):
+    # Длинный ответ по строкам, с разбивкой по лимиту длины сообщения Telegram
+    part = ""
+    for line in lines:
+        if len(part) + len(line) + 1 > 4000:
+            await msg.answer(part)
+            part = ""
+        part += line + "\n"
+    await msg.answer(part)
+
+
+async def notify_payments_confirmed(user_id, payments):
+    numbers = ", ".join(f"№{payment_id}" for payment_id, _ in payments)
+    total = sum(amount for _, amount in payments)
+    try:
+        await bot.send_message(user_id, f"✅ Оплата подтверждена ({numbers}).\nБаланс пополнен на {total} ₽.")
+    except Exception:
+        logging.exception("Не удалось уведомить пользователя %s", user_id)
+
+
+# ========= Рассылка =========
+@dp.message(Command("broadcast"))
+async def admin_broadcast(msg: types.Message):
+    if not await identity.is_admin(msg.from_user.id):
+        await msg.answer("❌ Только администратор может делать рассылку.")
+        return
+    parts = msg.text.split(maxsplit=1)
+    if len(parts) < 2:
+        await msg.answer("⚠️ Использование: /broadcast <текст>")
+        return
+
+    await msg.answer("📣 Рассылка запущена, по окончании пришлю итог.")
+    asyncio.create_task(broadcast(msg.chat.id, parts[1]))
+
+
+async def broadcast(admin_chat_id, text):
+    sent = failed = 0
+    last_id = 0
+    # Рассылка идёт в самом низком приоритете: ответы пользователям её обгоняют
+    with outbox.lane(outbox.LOW):
+        while True:
+            users = await get_user_ids(last_id, BROADCAST_CHUNK)
+            if not users:
+                break
+            last_id = users[-1][0]
+            results = await asyncio.gather(
+                *(bot.send_message(telegram_id, text) for _, telegram_id in users),
+                return_exceptions=True
+            )
+            failed_now = sum(isinstance(r, Exception) for r in results)
+            failed += failed_now
+            sent += len(results) - failed_now
+    await bot.send_message(admin_chat_id, f"📣 Рассылка завершена: доставлено {sent}, ошибок {failed}.")
+
+
+# ========= Остатки =========
+async def send_stock_alerts():
+    # Строки в stock_alerts пишет триггер, когда остаток товара опускается до порога или до нуля
+    alerts = await get_stock_alerts(100)
+    if not alerts:
+        return
+    admins = await get_admin_ids()
+    for _, product_id, available in alerts:
+        product = catalog.get_product(product_id)
+        name = product[1] if product else f"товар #{product_id}"
+        if available:
+            text = f"⚠️ Заканчиваются ключи: {name} — осталось {available} шт."
+        else:
+            text = f"❌ Закончились ключи: {name}"
+        await asyncio.gather(*(bot.send_message(admin_id, text) for admin_id in admins), return_exceptions=True)
+    await delete_stock_alerts([alert[0] for alert in alerts])
+
+
+async def watch_stock_alerts():
+    while True:
+        try:
+            await send_stock_alerts()
+        except Exception:
+            logging.exception("Не удалось разослать предупреждения об остатках")
+        await asyncio.sleep(CATALOG_POLL_SECONDS)
+
+
+# ========= Отчёты =========
+@dp.message(Command("report"))
+async def admin_report(msg: types.Message):
+    if not await identity.is_admin(msg.from_user.id):
+        await msg.answer("❌ У вас нет прав для просмотра этой информации.")
+        return
+    await msg.answer(await reports.build_report(), parse_mode="HTML")
+
+
+@dp.message(Command("export"))
+async def admin_export(msg: types.Message):
+    if not await identity.is_admin(msg.from_user.id):
+        await msg.answer("❌ У вас нет прав для просмотра этой информации.")
+        return
+    args = msg.text.split()
+    name = args[1] if len(args) > 1 else "sales"
+    export = reports.EXPORTS.get(name)
+    if export is None:
+        await msg.answer(f"Использование: /export [{'|'.join(reports.EXPORTS)}]")
         return
-    for payment_id in args[1:]:
-        payment_id = int(payment_id)
-        
-    # Получаем платёж
-        payment = get_payment(payment_id)
-        if not payment:
-            await msg.answer("❌ Платёж не найден.")
-            return
+    await bot.send_document(msg.chat.id, export())
 
-        set_payment_status(payment_id, "Оплачено")
-        user_id = payment[1]
-        amount = payment[2]
-        update_balance(user_id, amount)
 
-        await msg.answer(f"✅ Платёж №{payment_id} подтверждён.\nБаланс пользователя {user_id} пополнен на {amount} ₽.")
+# ========= Метрики =========
+@dp.message(Command("stats"))
+async def admin_stats(msg: types.Message):
+    if not await identity.is_admin(msg.from_user.id):
+        await msg.answer("❌ У вас нет прав для просмотра этой информации.")
+        return
+    await answer_lines(msg, metrics.render_stats().splitlines())
 
 
 # ========= Навигация назад =========
-@dp.callback_query(lambda c: c.data == "back_to_list")
-async def back_to_list(callback: CallbackQuery):
-    products = get_all_products()
-    text = "🛍️ Доступные товары:" if products else "❌ Нет товаров."
-    buttons = [[InlineKeyboardButton(text=p[1], callback_data=f"product_{p[0]}")] for p in products]
-    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons) if products else None
-    await callback.message.edit_text(text, reply_markup=keyboard)
+@callback_router.register(CatalogCb)
+async def back_to_list(callback: CallbackQuery, data: CatalogCb):
+    text = "🛍️ Доступные товары:" if catalog.products() else "❌ Нет товаров."
+    await callback.message.edit_text(text, reply_markup=catalog.list_keyboard())
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data == "balance_back")
-async def back_to_balance(callback: CallbackQuery):
-    balance = get_balance(callback.from_user.id)
+@callback_router.register(BalanceCb)
+async def back_to_balance(callback: CallbackQuery, data: BalanceCb):
+    balance = await get_balance(callback.from_user.id)
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Пополнить баланс", callback_data="add_balance")]
+        [InlineKeyboardButton(text="Пополнить баланс", callback_data=TopUpCb().pack())]
     ])
     await callback.message.edit_text(f"💰 Ваш баланс: {balance} ₽", reply_markup=keyboard)
     await callback.answer()
 
 @dp.message(Command("payments"))
 async def list_pending_payments(msg: types.Message):
-    if not is_admin(msg.from_user.id):
+    if not await identity.is_admin(msg.from_user.id):
         await msg.answer("❌ У вас нет прав для просмотра этой информации.")
         return
 
-    payments = get_pending_payments()
+    total = await count_pending_payments()
+    payments = await get_pending_payments_page(PAYMENTS_PER_PAGE)
     if not payments:
         await msg.answer("✅ Нет платежей со статусом 'на рассмотрении'.")
         return
 
-    await send_payments_page(msg.chat.id, payments, 1)
+    await send_payments_page(msg.chat.id, payments, 1, total)
 
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("payments_page_"))
-async def paginate_payments(callback: CallbackQuery):
-    if not is_admin(callback.from_user.id):
+@callback_router.register(PaymentsPageCb)
+async def paginate_payments(callback: CallbackQuery, data: PaymentsPageCb):
+    if not await identity.is_admin(callback.from_user.id):
         await callback.answer("❌ У вас нет прав для просмотра этой информации.", show_alert=True)
         return
 
-    page = int(callback.data.split("_")[-1])
-    payments = get_pending_payments()
-    await send_payments_page(callback.message.chat.id, payments, page, callback.message)
+    page, cursor = data.page, data.cursor
+    if data.direction == "next":
+        payments = await get_pending_payments_page(PAYMENTS_PER_PAGE, before_id=cursor)
+    else:
+        payments = await get_pending_payments_page(PAYMENTS_PER_PAGE, after_id=cursor)
+    total = await count_pending_payments()
+    if not payments:
+        await callback.answer("✅ Больше платежей на рассмотрении нет.", show_alert=True)
+        return
+    await send_payments_page(callback.message.chat.id, payments, page, total, callback.message)
     await callback.answer()
 
 
-async def send_payments_page(chat_id: int, payments: list, page: int, message: types.Message | None = None):
-    per_page = 10
-    total_pages = ceil(len(payments) / per_page)
-    start = (page - 1) * per_page
-    end = start + per_page
-    subset = payments[start:end]
+async def send_payments_page(chat_id: int, payments: list, page: int, total: int, message: types.Message | None = None):
+    total_pages = max(ceil(total / PAYMENTS_PER_PAGE), page)
 
     text_lines = []
-    for p in subset:
-        payment_id, user_id, amount, order_name, status, full_receipt = p
+    for p in payments:
+        payment_id, user_id, amount, order_name, status, full_receipt, duplicate_of = p
         text_lines.append(
             f"💳 <b>Платёж #{payment_id}</b>\n"
             f"👤 User ID: {user_id}\n"
             f"📦 {order_name}\n"
             f"💰 {amount} ₽\n"
-            f"📄 Статус: {status}\n"
+            f"📄 Статус: {STATUS_LABELS.get(status, status)}\n"
             f" ссылка на диск: {full_receipt}\n"
-            f"-----------------------------"
+            + (f"⚠️ Чек совпадает с чеком платежа #{duplicate_of}\n" if duplicate_of else "")
+            + f"-----------------------------"
         )
 
     text = "\n".join(text_lines)
@@ -386,9 +614,9 @@ async def send_payments_page(chat_id: int, payments: list, page: int, message: t
     # Кнопки пагинации
     buttons = []
     if page > 1:
-        buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"payments_page_{page - 1}"))
+        buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=PaymentsPageCb(page=page - 1, direction="prev", cursor=payments[0][0]).pack()))
     if page < total_pages:
-        buttons.append(InlineKeyboardButton(text="➡️ Вперёд", callback_data=f"payments_page_{page + 1}"))
+        buttons.append(InlineKeyboardButton(text="➡️ Вперёд", callback_data=PaymentsPageCb(page=page + 1, direction="next", cursor=payments[-1][0]).pack()))
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[buttons] if buttons else [])
 
@@ -398,10 +626,48 @@ async def send_payments_page(chat_id: int, payments: list, page: int, message: t
         await bot.send_message(chat_id, text, parse_mode="HTML", reply_markup=keyboard)
 
 
+async def receipt_upload_failed(payment_id, chat_id):
+    await bot.send_message(chat_id, "Не удалось загрузить скриншот, отправьте скриншот в поддержку")
+
+
+async def receipt_duplicate(payment_id, original_id):
+    text = (
+        f"⚠️ Чек платежа #{payment_id} побайтно совпадает с чеком платежа #{original_id} — "
+        f"скриншот использован повторно."
+    )
+    for admin_id in await get_admin_ids():
+        await bot.send_message(admin_id, text)
+
+
 # ========= MAIN =========
-async def main():
-    init_db()
-    await dp.start_polling(bot)
+async def main(index=0):
+    # index — номер процесса; фоновые очистки и регистрация вебхука нужны одни на всю базу
+    await init_db()
+    await catalog.reload()
+    asyncio.create_task(catalog.watch())
+    receipts.start(storage, on_failure=receipt_upload_failed, on_duplicate=receipt_duplicate)
+    if index == 0:
+        asyncio.create_task(cron.run(storage))
+        asyncio.create_task(fsm_storage.run_sweeper())
+        asyncio.create_task(watch_stock_alerts())
+    metrics_runner = await metrics.serve(METRICS_HOST, METRICS_PORT + index) if METRICS_PORT else None
+    try:
+        if MODE == "webhook":
+            await webhook.serve(dp, bot, reuse_port=processes > 1, register=index == 0)
+        else:
+            await dp.start_polling(bot)
+    finally:
+        await receipts.stop()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await flush_db()
+        close_db()
+
+def run_worker(index, processes):
+    asyncio.run(main(index))
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if processes > 1:
+        workers.run(run_worker, processes)
+    else:
+        asyncio.run(main())
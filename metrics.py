@@ -0,0 +1,134 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+# Задержки и ошибки по видам операций: обработчики бота (handler), запросы к базе (db),
+# Яндекс Диск (disk), запросы к Telegram API (telegram).
+# Для Prometheus — гистограммы с фиксированными границами, для /stats — p50/p99
+# по последним SAMPLES замерам каждой операции.
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SAMPLES = 2048
+
+_lock = threading.Lock()
+# (вид, имя) -> Metric
+_metrics = {}
+
+
+class Metric:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.buckets = [0] * len(BUCKETS)
+        self.samples = deque(maxlen=SAMPLES)
+
+    def percentile(self, q):
+        samples = sorted(self.samples)
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def observe(kind, name, seconds, error=False):
+    # Вызывается и из потоков базы, и из event loop
+    with _lock:
+        metric = _metrics.get((kind, name))
+        if metric is None:
+            metric = _metrics[(kind, name)] = Metric()
+        metric.count += 1
+        metric.total += seconds
+        if error:
+            metric.errors += 1
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                metric.buckets[i] += 1
+                break
+        metric.samples.append(seconds)
+
+
+@contextmanager
+def timer(kind, name):
+    started = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        observe(kind, name, time.perf_counter() - started, error)
+
+
+def snapshot():
+    with _lock:
+        return {
+            key: (m.count, m.errors, m.total, list(m.buckets), m.percentile(0.5), m.percentile(0.99))
+            for key, m in _metrics.items()
+        }
+
+
+def reset():
+    with _lock:
+        _metrics.clear()
+
+
+# ========= Вывод =========
+def render_stats():
+    lines = []
+    for (kind, name), (count, errors, _, _, p50, p99) in sorted(snapshot().items()):
+        lines.append(f"{kind}/{name}: {count} шт, ошибок {errors}, p50 {p50 * 1000:.1f} мс, p99 {p99 * 1000:.1f} мс")
+    return "\n".join(lines) or "Замеров пока нет."
+
+
+def render_prometheus():
+    lines = [
+        "# HELP bot_latency_seconds Latency of bot operations",
+        "# TYPE bot_latency_seconds histogram",
+    ]
+    data = sorted(snapshot().items())
+    for (kind, name), (count, _, total, buckets, _, _) in data:
+        labels = f'kind="{kind}",name="{name}"'
+        cumulative = 0
+        for bound, n in zip(BUCKETS, buckets):
+            cumulative += n
+            lines.append(f'bot_latency_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'bot_latency_seconds_bucket{{{labels},le="+Inf"}} {count}')
+        lines.append(f"bot_latency_seconds_sum{{{labels}}} {total}")
+        lines.append(f"bot_latency_seconds_count{{{labels}}} {count}")
+    lines.append("# HELP bot_errors_total Failed bot operations")
+    lines.append("# TYPE bot_errors_total counter")
+    for (kind, name), (_, errors, _, _, _, _) in data:
+        lines.append(f'bot_errors_total{{kind="{kind}",name="{name}"}} {errors}')
+    return "\n".join(lines) + "\n"
+
+
+async def handle_metrics(request):
+    return web.Response(text=render_prometheus(), content_type="text/plain", charset="utf-8")
+
+
+async def serve(host, port):
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+# ========= Middleware aiogram =========
+class HandlerMetricsMiddleware(BaseMiddleware):
+    # Внутренний middleware: вызывается уже для выбранного обработчика
+    async def __call__(self, handler, event, data):
+        with timer("handler", data["handler"].callback.__name__):
+            return await handler(event, data)
+
+
+class RequestMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        with timer("telegram", type(method).__name__):
+            return await make_request(bot, method)
@@ -0,0 +1,401 @@
+import time
+from datetime import datetime
+
+# Версионированные миграции схемы. Применённые версии записываются в schema_version,
+# каждая миграция выполняется в своей транзакции BEGIN IMMEDIATE, поэтому два процесса,
+# стартующие одновременно, не применят одну миграцию дважды.
+# Ранние миграции идемпотентны: базы, созданные до появления schema_version, проходят их без ошибок.
+# Новую миграцию — только добавлять в конец MIGRATIONS, уже выпущенные не менять.
+
+
+def _has_column(c, table, column):
+    return any(row[1] == column for row in c.execute(f"PRAGMA table_info({table})"))
+
+
+def _base_tables(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        telegram_id INTEGER UNIQUE,
+        balance REAL DEFAULT 0,
+        referrer INTEGER,
+        role TEXT DEFAULT 'user',
+        referral_bonus_given INTEGER DEFAULT 0
+    )''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS products (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT UNIQUE NOT NULL,
+        description TEXT,
+        price INTEGER NOT NULL
+    )''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS keys (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        product_id INTEGER NOT NULL,
+        key TEXT UNIQUE NOT NULL,
+        user_id INTEGER
+    )''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS payments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        amount REAL,
+        payment_id TEXT,
+        status TEXT DEFAULT 'на рассмотрении',
+        order_name TEXT,
+        details TEXT,
+        full_receipt TEXT,
+        data TEXT
+    )''')
+
+
+def _unsold_keys_index(c):
+    # Частичный индекс только по непроданным ключам: поиск свободного ключа не растёт вместе с продажами
+    c.execute("CREATE INDEX IF NOT EXISTS idx_keys_unsold ON keys (product_id) WHERE user_id IS NULL")
+
+
+def _catalog_version(c):
+    # Версия каталога: растёт при любом изменении products (в том числе из fill_products.py),
+    # по ней бот понимает, что закэшированный каталог устарел
+    c.execute('''CREATE TABLE IF NOT EXISTS meta (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    )''')
+    c.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('catalog_version', 0)")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS products_version_{event.lower()}
+            AFTER {event} ON products
+            BEGIN
+                UPDATE meta SET value = value + 1 WHERE name = 'catalog_version';
+            END''')
+
+
+def _pending_counter(c, status):
+    # Счётчик платежей на рассмотрении для /payments: поддерживается триггерами,
+    # чтобы номер последней страницы не требовал COUNT(*) на каждый клик
+    c.execute(
+        "INSERT OR IGNORE INTO meta (name, value) "
+        "SELECT 'pending_payments', COUNT(*) FROM payments WHERE status = ?", (status,)
+    )
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS payments_pending_insert
+        AFTER INSERT ON payments WHEN NEW.status IS '{status}'
+        BEGIN
+            UPDATE meta SET value = value + 1 WHERE name = 'pending_payments';
+        END''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS payments_pending_update
+        AFTER UPDATE OF status ON payments
+        WHEN (OLD.status IS '{status}') != (NEW.status IS '{status}')
+        BEGIN
+            UPDATE meta SET value = value + (NEW.status IS '{status}') - (OLD.status IS '{status}')
+            WHERE name = 'pending_payments';
+        END''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS payments_pending_delete
+        AFTER DELETE ON payments WHEN OLD.status IS '{status}'
+        BEGIN
+            UPDATE meta SET value = value - 1 WHERE name = 'pending_payments';
+        END''')
+
+
+def _pending_payments(c):
+    c.execute("CREATE INDEX IF NOT EXISTS idx_payments_status ON payments (status, id)")
+    _pending_counter(c, 'На рассмотрении')
+
+
+def _paid_at(c):
+    # Время оплаты в виде unix-времени: по нему и индексу (status, paid_at)
+    # очистка выбирает только просроченные строки, без разбора строки data
+    if not _has_column(c, "payments", "paid_at"):
+        c.execute("ALTER TABLE payments ADD COLUMN paid_at INTEGER")
+        rows = c.execute(
+            "SELECT id, data FROM payments WHERE status = 'Оплачено' AND data IS NOT NULL"
+        ).fetchall()
+        c.executemany(
+            "UPDATE payments SET paid_at = ? WHERE id = ?",
+            [(int(datetime.strptime(data, '%d.%m.%Y').timestamp()), payment_id) for payment_id, data in rows]
+        )
+    c.execute("CREATE INDEX IF NOT EXISTS idx_payments_paid_at ON payments (status, paid_at)")
+
+
+def _fsm(c):
+    # Состояния FSM (пополнение баланса и т.п.) переживают перезапуск бота
+    c.execute('''CREATE TABLE IF NOT EXISTS fsm (
+        key TEXT PRIMARY KEY,
+        state TEXT,
+        data TEXT,
+        updated_at INTEGER NOT NULL
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_fsm_updated_at ON fsm (updated_at)")
+
+
+def _total_spent(c):
+    # Сумма покупок пользователя ведётся при каждой покупке, а не считается заново
+    if not _has_column(c, "users", "total_spent"):
+        c.execute("ALTER TABLE users ADD COLUMN total_spent REAL DEFAULT 0")
+        c.execute("""
+            UPDATE users SET total_spent = COALESCE((
+                SELECT SUM(p.price) FROM keys k
+                JOIN products p ON k.product_id = p.id
+                WHERE k.user_id = users.telegram_id
+            ), 0)
+        """)
+
+
+def _status_codes(c):
+    # Статусы платежей — короткие коды вместо русских строк, которые к тому же
+    # расходились регистром ('на рассмотрении' при создании, 'На рассмотрении' после чека).
+    # SQLite не умеет менять DEFAULT колонки, поэтому таблица пересобирается.
+    row = c.execute("SELECT seq FROM sqlite_sequence WHERE name = 'payments'").fetchone()
+    c.execute('''CREATE TABLE payments_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        amount REAL,
+        payment_id TEXT,
+        status TEXT NOT NULL DEFAULT 'new',
+        order_name TEXT,
+        details TEXT,
+        full_receipt TEXT,
+        data TEXT,
+        paid_at INTEGER
+    )''')
+    c.execute("""
+        INSERT INTO payments_new (id, user_id, amount, payment_id, status, order_name, details, full_receipt, data, paid_at)
+        SELECT id, user_id, amount, payment_id,
+               CASE status WHEN 'Оплачено' THEN 'paid' WHEN 'На рассмотрении' THEN 'review' ELSE 'new' END,
+               order_name, details, full_receipt, data, paid_at
+        FROM payments
+    """)
+    c.execute("DROP TABLE payments")
+    c.execute("ALTER TABLE payments_new RENAME TO payments")
+    if row:
+        c.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'payments'", (row[0],))
+
+    c.execute("CREATE INDEX idx_payments_status ON payments (status, id)")
+    c.execute("CREATE INDEX idx_payments_paid_at ON payments (status, paid_at)")
+    c.execute("CREATE INDEX idx_payments_user ON payments (user_id, id)")
+    c.execute("DELETE FROM meta WHERE name = 'pending_payments'")
+    _pending_counter(c, 'review')
+
+
+def _stock(c):
+    # Остаток непроданных ключей по товарам ведут триггеры на keys — каталог показывает
+    # наличие без COUNT(*). Каждое изменение остатка увеличивает stock_version, по ней
+    # процессы перечитывают только остатки. Пересечение порога low_stock_threshold
+    # (и обнуление остатка) пишет строку в stock_alerts — оттуда бот рассылает предупреждения админам.
+    c.execute('''CREATE TABLE stock (
+        product_id INTEGER PRIMARY KEY,
+        available INTEGER NOT NULL DEFAULT 0
+    )''')
+    c.execute(
+        "INSERT INTO stock (product_id, available) "
+        "SELECT product_id, COUNT(*) FROM keys WHERE user_id IS NULL GROUP BY product_id"
+    )
+    c.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('stock_version', 0)")
+    c.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('low_stock_threshold', 0)")
+    c.execute('''CREATE TABLE stock_alerts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        product_id INTEGER NOT NULL,
+        available INTEGER NOT NULL,
+        created_at INTEGER NOT NULL
+    )''')
+
+    c.execute('''CREATE TRIGGER keys_stock_insert
+        AFTER INSERT ON keys WHEN NEW.user_id IS NULL
+        BEGIN
+            INSERT INTO stock (product_id, available) VALUES (NEW.product_id, 1)
+            ON CONFLICT (product_id) DO UPDATE SET available = available + 1;
+        END''')
+    c.execute('''CREATE TRIGGER keys_stock_update
+        AFTER UPDATE OF user_id, product_id ON keys
+        WHEN OLD.user_id IS NULL OR NEW.user_id IS NULL
+        BEGIN
+            UPDATE stock SET available = available - 1
+            WHERE product_id = OLD.product_id AND OLD.user_id IS NULL;
+            INSERT INTO stock (product_id, available) SELECT NEW.product_id, 1 WHERE NEW.user_id IS NULL
+            ON CONFLICT (product_id) DO UPDATE SET available = available + 1;
+        END''')
+    c.execute('''CREATE TRIGGER keys_stock_delete
+        AFTER DELETE ON keys WHEN OLD.user_id IS NULL
+        BEGIN
+            UPDATE stock SET available = available - 1 WHERE product_id = OLD.product_id;
+        END''')
+
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        c.execute(f'''CREATE TRIGGER stock_version_{event.lower()}
+            AFTER {event} ON stock
+            BEGIN
+                UPDATE meta SET value = value + 1 WHERE name = 'stock_version';
+            END''')
+    c.execute('''CREATE TRIGGER stock_low
+        AFTER UPDATE OF available ON stock
+        WHEN NEW.available < OLD.available AND (
+            NEW.available = 0
+            OR NEW.available <= (SELECT value FROM meta WHERE name = 'low_stock_threshold')
+               AND OLD.available > (SELECT value FROM meta WHERE name = 'low_stock_threshold')
+        )
+        BEGIN
+            INSERT INTO stock_alerts (product_id, available, created_at)
+            VALUES (NEW.product_id, NEW.available, CAST(strftime('%s', 'now') AS INTEGER));
+        END''')
+
+    # Список админов для предупреждений — без прохода по всем пользователям
+    c.execute("CREATE INDEX idx_users_admin ON users (telegram_id) WHERE role = 'admin'")
+
+
+def _purchases(c):
+    # История покупок: время покупки ключа и индекс по владельцу — страница «Мои покупки»
+    # читается по индексу, сколько бы ключей ни было у пользователя.
+    # Для ключей, проданных до миграции, время неизвестно — ставим 0.
+    c.execute("ALTER TABLE keys ADD COLUMN purchased_at INTEGER")
+    c.execute("UPDATE keys SET purchased_at = 0 WHERE user_id IS NOT NULL")
+    c.execute("CREATE INDEX idx_keys_user ON keys (user_id, purchased_at, id)")
+
+
+def _rollups(c):
+    # Дневные итоги: продажи по товарам и подтверждённые пополнения. Триггеры дописывают их
+    # в той же транзакции, что и покупку/подтверждение, поэтому отчёт не читает keys и payments,
+    # а очистка старых платежей историю не стирает. День — по местному времени.
+    # Ключи, проданные до появления purchased_at, попадают в день 1970-01-01.
+    c.execute('''CREATE TABLE sales_daily (
+        day TEXT NOT NULL,
+        product_id INTEGER NOT NULL,
+        sold INTEGER NOT NULL DEFAULT 0,
+        revenue REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, product_id)
+    ) WITHOUT ROWID''')
+    c.execute('''CREATE TABLE payments_daily (
+        day TEXT PRIMARY KEY,
+        confirmed INTEGER NOT NULL DEFAULT 0,
+        amount REAL NOT NULL DEFAULT 0
+    ) WITHOUT ROWID''')
+
+    c.execute("""
+        INSERT INTO sales_daily (day, product_id, sold, revenue)
+        SELECT date(k.purchased_at, 'unixepoch', 'localtime'), k.product_id, COUNT(*), COALESCE(SUM(p.price), 0)
+        FROM keys k LEFT JOIN products p ON p.id = k.product_id
+        WHERE k.user_id IS NOT NULL
+        GROUP BY 1, 2
+    """)
+    c.execute("""
+        INSERT INTO payments_daily (day, confirmed, amount)
+        SELECT date(paid_at, 'unixepoch', 'localtime'), COUNT(*), COALESCE(SUM(amount), 0)
+        FROM payments
+        WHERE status = 'paid' AND paid_at IS NOT NULL
+        GROUP BY 1
+    """)
+
+    c.execute('''CREATE TRIGGER keys_sales
+        AFTER UPDATE OF user_id ON keys
+        WHEN OLD.user_id IS NULL AND NEW.user_id IS NOT NULL
+        BEGIN
+            INSERT INTO sales_daily (day, product_id, sold, revenue)
+            VALUES (
+                date(COALESCE(NEW.purchased_at, strftime('%s', 'now')), 'unixepoch', 'localtime'),
+                NEW.product_id, 1,
+                COALESCE((SELECT price FROM products WHERE id = NEW.product_id), 0)
+            )
+            ON CONFLICT (day, product_id) DO UPDATE SET sold = sold + 1, revenue = revenue + excluded.revenue;
+        END''')
+    c.execute('''CREATE TRIGGER payments_paid
+        AFTER UPDATE OF status ON payments
+        WHEN NEW.status = 'paid' AND OLD.status IS NOT 'paid'
+        BEGIN
+            INSERT INTO payments_daily (day, confirmed, amount)
+            VALUES (date(COALESCE(NEW.paid_at, strftime('%s', 'now')), 'unixepoch', 'localtime'), 1, NEW.amount)
+            ON CONFLICT (day) DO UPDATE SET confirmed = confirmed + 1, amount = amount + excluded.amount;
+        END''')
+
+
+def _receipt_hash(c):
+    # Хэш изображения чека и ссылка на платёж, чей чек совпал: повторный скриншот
+    # находится по индексу и не загружается на диск второй раз
+    c.execute("ALTER TABLE payments ADD COLUMN receipt_hash TEXT")
+    c.execute("ALTER TABLE payments ADD COLUMN duplicate_of INTEGER")
+    c.execute("CREATE INDEX idx_payments_receipt_hash ON payments (receipt_hash) WHERE receipt_hash IS NOT NULL")
+
+
+def _ledger(c):
+    # Журнал движений баланса в целых копейках: пополнения, покупки, реферальные бонусы, ручные правки.
+    # Только добавление — UPDATE и DELETE запрещены триггерами. users.balance_kopecks — кэш суммы
+    # по журналу; его ведёт триггер в той же транзакции, что и запись в журнал.
+    # Прежний REAL-баланс переводится в копейки и попадает в журнал одной начальной записью (opening).
+    c.execute('''CREATE TABLE ledger (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        kopecks INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        ref INTEGER,
+        created_at INTEGER NOT NULL
+    )''')
+    # История пользователя по порядку и покрывающий индекс для сверки сумм без сортировки
+    c.execute("CREATE INDEX idx_ledger_user ON ledger (user_id, id, kopecks)")
+    c.execute("ALTER TABLE users ADD COLUMN balance_kopecks INTEGER NOT NULL DEFAULT 0")
+    c.execute("UPDATE users SET balance_kopecks = CAST(ROUND(COALESCE(balance, 0) * 100) AS INTEGER)")
+    c.execute('''
+        INSERT INTO ledger (user_id, kopecks, kind, created_at)
+        SELECT telegram_id, balance_kopecks, 'opening', ? FROM users
+        WHERE telegram_id IS NOT NULL AND balance_kopecks != 0
+        ORDER BY telegram_id
+    ''', (int(time.time()),))
+    c.execute("ALTER TABLE users DROP COLUMN balance")
+
+    c.execute('''CREATE TRIGGER ledger_balance AFTER INSERT ON ledger
+        BEGIN
+            UPDATE users SET balance_kopecks = balance_kopecks + NEW.kopecks WHERE telegram_id = NEW.user_id;
+        END''')
+    c.execute('''CREATE TRIGGER ledger_no_update BEFORE UPDATE ON ledger
+        BEGIN
+            SELECT RAISE(ABORT, 'ledger is append-only');
+        END''')
+    c.execute('''CREATE TRIGGER ledger_no_delete BEFORE DELETE ON ledger
+        BEGIN
+            SELECT RAISE(ABORT, 'ledger is append-only');
+        END''')
+
+
+def _receipt_sha(c):
+    # Точный хэш байтов чека: повторно не загружается только побайтно тот же файл.
+    # Совпадение перцептивного хэша лишь помечает платёж (duplicate_of), чек всё равно загружается.
+    # Индекс по duplicate_of нужен очистке: исходный платёж не удаляется, пока его файл
+    # использует дубликат.
+    c.execute("ALTER TABLE payments ADD COLUMN receipt_sha TEXT")
+    c.execute("CREATE INDEX idx_payments_receipt_sha ON payments (receipt_sha) WHERE receipt_sha IS NOT NULL")
+    c.execute("CREATE INDEX idx_payments_duplicate_of ON payments (duplicate_of) WHERE duplicate_of IS NOT NULL")
+
+
+MIGRATIONS = [
+    _base_tables,
+    _unsold_keys_index,
+    _catalog_version,
+    _pending_payments,
+    _paid_at,
+    _fsm,
+    _total_spent,
+    _status_codes,
+    _stock,
+    _purchases,
+    _rollups,
+    _receipt_hash,
+    _ledger,
+    _receipt_sha,
+]
+
+
+def migrate(conn):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        applied_at INTEGER NOT NULL
+    )''')
+    conn.commit()
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            if c.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,)).fetchone():
+                conn.rollback()
+                continue
+            migration(c)
+            c.execute("INSERT INTO schema_version (version, applied_at) VALUES (?, ?)", (version, int(time.time())))
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
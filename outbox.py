@@ -0,0 +1,134 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import time
+from contextlib import contextmanager
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from config import SEND_RATE, SEND_BURST, CHAT_RATE, CHAT_BURST, SEND_RETRIES
+
+# Ограничение исходящих сообщений под лимиты Telegram.
+# Все запросы бота с chat_id (send_message, edit_text, answer, ...) проходят через
+# middleware сессии: сначала ведро чата (CHAT_RATE в секунду), потом общее ведро
+# (SEND_RATE в секунду). Общие токены раздаются по приоритету, поэтому ответы
+# на покупки обгоняют рассылку. На 429 (retry_after) отправка ставится на паузу целиком
+# и запрос повторяется.
+
+HIGH, NORMAL, LOW = 0, 1, 2
+_priority = contextvars.ContextVar("outbox_priority", default=NORMAL)
+
+
+@contextmanager
+def lane(priority):
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        # Забирает токен в долг и возвращает, сколько ждать до его появления
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def wait_time(self):
+        self._refill(time.monotonic())
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def idle(self):
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+class PriorityLimiter:
+    # Общее ведро: ожидающие стоят в куче по (приоритет, порядок прихода)
+    def __init__(self, rate=SEND_RATE, burst=SEND_BURST):
+        self.bucket = TokenBucket(rate, burst)
+        self.paused_until = 0
+        self._waiters = []
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._task = None
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, priority):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        self._wakeup.set()
+        await future
+
+    async def _run(self):
+        while True:
+            while not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            delay = max(self.bucket.wait_time(), self.paused_until - time.monotonic())
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self.bucket.take()
+            future.set_result(None)
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    def __init__(self, rate=SEND_RATE, burst=SEND_BURST, chat_rate=CHAT_RATE, chat_burst=CHAT_BURST, retries=SEND_RETRIES):
+        self.limiter = PriorityLimiter(rate, burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.retries = retries
+        self._chats = {}
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                # Вёдра чатов, которые давно ничего не получали, полные — их можно забыть
+                for key in [k for k, b in self._chats.items() if b.idle()]:
+                    del self._chats[key]
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        delay = self._chat_bucket(chat_id).reserve()
+        if delay:
+            await asyncio.sleep(delay)
+        priority = _priority.get()
+        for attempt in range(self.retries + 1):
+            await self.limiter.acquire(priority)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self.retries:
+                    raise
+                self.limiter.pause(e.retry_after)
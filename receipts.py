@@ -0,0 +1,184 @@
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import yadisk
+import metrics
+from async_db import save_receipt, link_receipt
+from config import UPLOAD_WORKERS, UPLOAD_QUEUE_SIZE, UPLOAD_RETRIES, UPLOAD_BACKOFF
+from config import RECEIPT_MAX_SIDE, RECEIPT_QUALITY
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Загрузка скриншотов оплаты в фоне: get_photo кладёт байты в очередь и сразу отвечает
+# пользователю, а воркеры грузят их в хранилище и записывают ссылку через save_receipt.
+# Перед загрузкой чек уменьшается и пережимается. Побайтно тот же чек (sha1 исходных байтов)
+# не загружается повторно: платёж получает ссылку на уже загруженный файл, а админам уходит
+# предупреждение. Перцептивные хэши здесь не подходят: у скриншотов одного банковского
+# приложения с разными суммами они совпадают так же, как у пережатой копии одного чека.
+# Без Pillow чек грузится как есть.
+
+
+def receipt_name(payment_id):
+    return f"payment_{payment_id}.jpg"
+
+
+# ========= Хранилища =========
+class YandexDiskStorage:
+    # Синхронный клиент yadisk вызывается в отдельном потоке, файл грузится прямо из памяти
+    def __init__(self, client, folder="/yadisk"):
+        self.client = client
+        self.folder = folder
+
+    def _upload(self, name, data):
+        path = f"{self.folder}/{name}"
+        with metrics.timer("disk", "upload"):
+            self.client.upload(io.BytesIO(data), path, overwrite=True)
+        with metrics.timer("disk", "publish"):
+            self.client.publish(path)
+        with metrics.timer("disk", "get_meta"):
+            return self.client.get_meta(path).public_url
+
+    def _delete(self, name):
+        # Уже удалённый файл — не ошибка, строку платежа всё равно можно чистить
+        try:
+            with metrics.timer("disk", "remove"):
+                self.client.remove(f"{self.folder}/{name}")
+        except yadisk.exceptions.PathNotFoundError:
+            pass
+
+    async def upload(self, name, data):
+        return await asyncio.to_thread(self._upload, name, data)
+
+    async def delete(self, name):
+        await asyncio.to_thread(self._delete, name)
+
+
+class LocalStorage:
+    # Замена Яндекс Диска для тестов и бенчмарков: файлы кладутся в локальную папку
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def _upload(self, name, data):
+        path = os.path.join(self.folder, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return "file://" + os.path.abspath(path)
+
+    def _delete(self, name):
+        try:
+            os.remove(os.path.join(self.folder, name))
+        except FileNotFoundError:
+            pass
+
+    async def upload(self, name, data):
+        return await asyncio.to_thread(self._upload, name, data)
+
+    async def delete(self, name):
+        await asyncio.to_thread(self._delete, name)
+
+
+# ========= Обработка изображения =========
+def prepare(data, max_side=RECEIPT_MAX_SIDE, quality=RECEIPT_QUALITY):
+    # Возвращает (байты для загрузки, sha1 исходных байтов); вызывается в отдельном потоке
+    receipt_sha = hashlib.sha1(data).hexdigest()
+    if Image is None:
+        return data, receipt_sha
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            # Слишком большой JPEG декодируется сразу уменьшенным в 2/4/8 раз — дешевле полного
+            image.draft("RGB", (max_side, max_side))
+            image = image.convert("RGB")
+            image.thumbnail((max_side, max_side))
+            out = io.BytesIO()
+            image.save(out, "JPEG", quality=quality)
+    except Exception:
+        logging.warning("Не удалось обработать изображение чека, загружаем как есть", exc_info=True)
+        return data, receipt_sha
+    result = out.getvalue()
+    # Маленький исходник после пережатия может стать только больше
+    return (result if len(result) < len(data) else data), receipt_sha
+
+
+# ========= Очередь загрузок =========
+_queue = None
+_workers = []
+_storage = None
+_on_failure = None
+_on_duplicate = None
+
+
+async def _upload_with_retry(payment_id, data):
+    delay = UPLOAD_BACKOFF
+    for attempt in range(1, UPLOAD_RETRIES + 1):
+        try:
+            return await _storage.upload(receipt_name(payment_id), data)
+        except Exception:
+            if attempt == UPLOAD_RETRIES:
+                raise
+            logging.warning("Загрузка чека %s не удалась (попытка %s), повтор через %s с",
+                            payment_id, attempt, delay)
+            await asyncio.sleep(delay)
+            delay *= 2
+
+
+async def _notify(callback, *args):
+    if callback is None:
+        return
+    try:
+        await callback(*args)
+    except Exception:
+        logging.exception("Не удалось отправить уведомление о чеке %s", args[0])
+
+
+async def _process(payment_id, data, chat_id):
+    with metrics.timer("receipts", "prepare"):
+        data, receipt_sha = await asyncio.to_thread(prepare, data)
+    original_id = await link_receipt(payment_id, receipt_sha)
+    if original_id is None:
+        url = await _upload_with_retry(payment_id, data)
+        # Тот же чек мог одновременно загрузиться для другого платежа
+        original_id = await save_receipt(payment_id, url, receipt_sha)
+    if original_id is not None:
+        await _notify(_on_duplicate, payment_id, original_id)
+
+
+async def _worker():
+    while True:
+        payment_id, data, chat_id = await _queue.get()
+        try:
+            await _process(payment_id, data, chat_id)
+        except Exception:
+            logging.exception("Не удалось загрузить чек для платежа %s", payment_id)
+            await _notify(_on_failure, payment_id, chat_id)
+        finally:
+            _queue.task_done()
+
+
+def start(storage, on_failure=None, on_duplicate=None, workers=UPLOAD_WORKERS):
+    global _queue, _storage, _on_failure, _on_duplicate
+    _storage = storage
+    _on_failure = on_failure
+    _on_duplicate = on_duplicate
+    _queue = asyncio.Queue(maxsize=UPLOAD_QUEUE_SIZE)
+    _workers.extend(asyncio.create_task(_worker()) for _ in range(workers))
+
+
+async def submit(payment_id, data, chat_id=None):
+    # Если очередь полна, ждём свободного места, а не копим байты без ограничения
+    await _queue.put((payment_id, data, chat_id))
+
+
+async def stop():
+    # Дожидаемся уже принятых чеков, потом гасим воркеры
+    if _queue is not None:
+        await _queue.join()
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
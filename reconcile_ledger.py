@@ -0,0 +1,66 @@
+# Сверка кэша балансов с журналом: суммы по ledger (покрывающий индекс idx_ledger_user)
+# и users.balance_kopecks читаются двумя потоками, упорядоченными по telegram_id,
+# и сливаются за один проход — память не зависит ни от числа пользователей, ни от числа записей.
+# Оба чтения идут в одной транзакции (один снимок WAL), поэтому сверку можно запускать на работающем боте.
+# С --fix кэш расходящихся пользователей пересчитывается из журнала.
+# Запуск: python reconcile_ledger.py [--fix]  (код возврата 1, если найдены расхождения)
+import sys
+import time
+import db
+
+SHOW = 20
+
+
+def reconcile(conn):
+    # Возвращает (пользователей проверено, [(telegram_id, кэш, по журналу)]);
+    # кэш None — записи в журнале есть, а пользователя нет
+    mismatches = []
+    checked = 0
+    conn.execute("BEGIN")
+    try:
+        totals = db.iter_ledger_totals(conn)
+        balances = db.iter_cached_balances(conn)
+        total = next(totals, None)
+        balance = next(balances, None)
+        while total is not None or balance is not None:
+            if balance is None or (total is not None and total[0] < balance[0]):
+                mismatches.append((total[0], None, total[1]))
+                total = next(totals, None)
+                continue
+            checked += 1
+            if total is not None and total[0] == balance[0]:
+                expected = total[1]
+                total = next(totals, None)
+            else:
+                expected = 0
+            if balance[1] != expected:
+                mismatches.append((balance[0], balance[1], expected))
+            balance = next(balances, None)
+    finally:
+        conn.rollback()
+    return checked, mismatches
+
+
+def main(fix=False):
+    db.init_db()
+    started = time.perf_counter()
+    checked, mismatches = reconcile(db.get_conn())
+    elapsed = time.perf_counter() - started
+
+    for telegram_id, cached, expected in mismatches[:SHOW]:
+        if cached is None:
+            print(f"пользователь {telegram_id}: нет в users, по журналу {expected / 100:.2f} ₽")
+        else:
+            print(f"пользователь {telegram_id}: в кэше {cached / 100:.2f} ₽, по журналу {expected / 100:.2f} ₽")
+    if len(mismatches) > SHOW:
+        print(f"... и ещё {len(mismatches) - SHOW}")
+    print(f"пользователей проверено: {checked} за {elapsed:.2f} с, расхождений: {len(mismatches)}")
+
+    if fix and mismatches:
+        db.rebuild_cached_balances([telegram_id for telegram_id, cached, _ in mismatches if cached is not None])
+        print("кэш пересчитан из журнала")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(fix="--fix" in sys.argv[1:]))
@@ -0,0 +1,31 @@
+# Отправка записанных обновлений Telegram на локальный вебхук.
+# Файл — JSON-массив обновлений или по одному JSON-объекту на строку.
+# Запуск: python replay_updates.py updates.json [http://127.0.0.1:8080/webhook]
+import asyncio
+import json
+import sys
+from aiohttp import ClientSession
+from config import WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET
+
+
+def load_updates(path):
+    with open(path, "r", encoding="utf-8") as file:
+        text = file.read().strip()
+    if text.startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+async def replay(path, url):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET} if WEBHOOK_SECRET else {}
+    statuses = {}
+    async with ClientSession() as session:
+        for update in load_updates(path):
+            async with session.post(url, json=update, headers=headers) as response:
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+    print(statuses)
+
+
+if __name__ == "__main__":
+    url = sys.argv[2] if len(sys.argv) > 2 else f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}"
+    asyncio.run(replay(sys.argv[1], url))
@@ -0,0 +1,103 @@
+import csv
+import io
+import time
+from aiogram.types import InputFile
+from async_db import (
+    get_sales_totals,
+    get_topup_totals,
+    get_top_products,
+    get_sales_rows,
+    get_payments_rows,
+    STATUS_LABELS,
+)
+from config import EXPORT_CHUNK
+
+# Отчёты для админов. /report читает только дневные сводки (sales_daily, payments_daily),
+# которые ведут триггеры, — время ответа не зависит от числа продаж и платежей.
+# Выгрузка CSV — InputFile, который читает базу порциями по EXPORT_CHUNK строк
+# и сразу отдаёт их в запрос к Telegram: в памяти не больше одной порции.
+
+PERIODS = (("Сегодня", 0), ("7 дней", 6), ("30 дней", 29), ("Всё время", None))
+TOP_PRODUCTS = 5
+
+
+def _day(days_ago):
+    if days_ago is None:
+        return ""
+    return time.strftime("%Y-%m-%d", time.localtime(time.time() - days_ago * 86400))
+
+
+async def build_report():
+    lines = ["📊 <b>Отчёт</b>"]
+    for title, days_ago in PERIODS:
+        since = _day(days_ago)
+        sold, revenue = await get_sales_totals(since)
+        confirmed, amount = await get_topup_totals(since)
+        lines.append(
+            f"\n<b>{title}</b>\n"
+            f"🛒 Продано: {sold} шт. на {revenue:,.2f} ₽\n"
+            f"💳 Пополнений: {confirmed} на {amount:,.2f} ₽"
+        )
+    top = await get_top_products(_day(29), TOP_PRODUCTS)
+    if top:
+        lines.append("\n<b>Топ товаров за 30 дней</b>")
+        for place, (product_id, name, sold, revenue) in enumerate(top, start=1):
+            lines.append(f"{place}. {name or f'товар #{product_id}'} — {sold} шт., {revenue:,.2f} ₽")
+    return "\n".join(lines)
+
+
+class CsvExport(InputFile):
+    # fetch(cursor, limit) — порция строк после курсора, next_cursor(row) — курсор по последней строке
+    def __init__(self, filename, header, fetch, cursor, next_cursor, convert=None, chunk=EXPORT_CHUNK):
+        super().__init__(filename)
+        self.header = header
+        self.fetch = fetch
+        self.cursor = cursor
+        self.next_cursor = next_cursor
+        self.convert = convert
+        self.chunk = chunk
+
+    async def read(self, bot):
+        # Генератор создаётся заново на каждую попытку отправки, поэтому повтор после RetryAfter
+        # выгружает файл с начала
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(self.header)
+        # BOM — чтобы Excel открыл кириллицу в UTF-8
+        yield ("\ufeff" + buffer.getvalue()).encode()
+        cursor = self.cursor
+        while True:
+            rows = await self.fetch(cursor, self.chunk)
+            if not rows:
+                break
+            cursor = self.next_cursor(rows[-1])
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(map(self.convert, rows) if self.convert else rows)
+            yield buffer.getvalue().encode()
+            if len(rows) < self.chunk:
+                break
+
+
+def _date(ts):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts)) if ts else ""
+
+
+def sales_csv():
+    return CsvExport(
+        f"sales_{time.strftime('%Y%m%d')}.csv",
+        ("day", "product_id", "product", "sold", "revenue"),
+        get_sales_rows, ("", 0), lambda row: (row[0], row[1]),
+    )
+
+
+def payments_csv():
+    return CsvExport(
+        f"payments_{time.strftime('%Y%m%d')}.csv",
+        ("id", "user_id", "amount", "status", "order", "paid_at"),
+        get_payments_rows, 0, lambda row: row[0],
+        convert=lambda row: (row[0], row[1], row[2], STATUS_LABELS.get(row[3], row[3]), row[4], _date(row[5])),
+    )
+
+
+EXPORTS = {"sales": sales_csv, "payments": payments_csv}
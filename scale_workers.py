@@ -0,0 +1,214 @@
+# Проверка режима нескольких процессов: для каждого числа процессов поднимаются настоящие
+# процессы бота (webhook + SO_REUSEPORT, заглушка вместо Telegram API) над общей временной базой,
+# отдельные процессы-клиенты шлют в вебхук синтетические обновления (/start, каталог, покупки, баланс).
+# Замеряется пропускная способность от первого запроса до последнего обработанного обновления,
+# затем проверяется, что ни один ключ не продан дважды и балансы сходятся с покупками.
+# Почти линейный рост проверяется, только если ядер хватает и процессам бота, и клиентам.
+# Запуск: python scale_workers.py --processes 1 2 4 --users 400
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import time
+
+import bench
+
+PRICE = 100
+BALANCE = 1000
+EFFICIENCY = 0.7
+
+
+def bot_process(index, processes, path, port, handled):
+    # Выполняется в дочернем процессе (spawn): настраиваем конфиг до импорта main
+    import config
+    config.MODE = "webhook"
+    config.PROCESSES = processes
+    config.WEBHOOK_URL = None
+    config.WEBHOOK_HOST = "127.0.0.1"
+    config.WEBHOOK_PORT = port
+    import db
+    db.DB_PATH = path
+    import logging
+    import main
+    import receipts
+    logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+    logging.getLogger("aiohttp.access").setLevel(logging.WARNING)
+    main.bot.session = bench.FakeSession()
+    main.storage = receipts.LocalStorage(os.path.join(os.path.dirname(path), "receipts"))
+
+    async def count(handler, event, data):
+        try:
+            return await handler(event, data)
+        finally:
+            with handled.get_lock():
+                handled.value += 1
+
+    main.dp.update.outer_middleware(count)
+    main.run_worker(index, processes)
+
+
+def updates(users, products):
+    from callbacks import ProductCb, BuyCb
+    result = []
+    for i in range(users):
+        uid = bench.user_id(i)
+        product_id = i % products + 1
+        flow = [
+            bench.message_update(uid, "/start"),
+            bench.message_update(uid, "🛒 Купить ключ"),
+            bench.callback_update(uid, ProductCb(product_id=product_id).pack()),
+        ]
+        # Денег хватает на BALANCE // PRICE ключей, остальные покупки упираются в баланс
+        flow += [bench.callback_update(uid, BuyCb(product_id=product_id, quantity=1).pack()) for _ in range(BALANCE // PRICE + 2)]
+        flow.append(bench.message_update(uid, "💰 Баланс"))
+        result.append([json.dumps(u.model_dump(mode="json", exclude_none=True)).encode() for u in flow])
+    return result
+
+
+def client_process(flows, port, concurrency):
+    # Обновления одного пользователя идут по порядку, разные пользователи — параллельно
+    import aiohttp
+
+    async def run():
+        url = f"http://127.0.0.1:{port}/webhook"
+        limit = asyncio.Semaphore(concurrency)
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            async def send(body):
+                while True:
+                    async with session.post(url, data=body, headers={"Content-Type": "application/json"}) as response:
+                        if response.status != 503:
+                            return
+                    await asyncio.sleep(0.05)
+
+            async def flow(bodies):
+                async with limit:
+                    for body in bodies:
+                        await send(body)
+
+            await asyncio.gather(*(flow(bodies) for bodies in flows))
+
+    asyncio.run(run())
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("процессы бота не запустились")
+
+
+def run(processes, args):
+    import db
+    import reconcile_ledger
+    tmp = tempfile.mkdtemp(prefix="scale_")
+    path = os.path.join(tmp, "scale.db")
+    db.DB_PATH = path
+    db.init_db()
+    conn = db.get_conn()
+    with conn:
+        conn.executemany(
+            "INSERT INTO products (name, description, price) VALUES (?, ?, ?)",
+            [(f"Товар {i}", "", PRICE) for i in range(args.products)]
+        )
+        # Ключей меньше, чем покупателям хочется: часть покупок упирается в склад
+        conn.executemany(
+            "INSERT INTO keys (product_id, key) VALUES (?, ?)",
+            ((i % args.products + 1, f"KEY-{i:08d}") for i in range(args.users * 4))
+        )
+        conn.executemany("INSERT INTO users (telegram_id) VALUES (?)", [(bench.user_id(i),) for i in range(args.users)])
+        conn.executemany(
+            "INSERT INTO ledger (user_id, kopecks, kind, created_at) VALUES (?, ?, ?, 0)",
+            [(bench.user_id(i), db.to_kopecks(BALANCE), db.LEDGER_ADJUST) for i in range(args.users)]
+        )
+
+    flows = updates(args.users, args.products)
+    total = sum(len(f) for f in flows)
+    ctx = multiprocessing.get_context("spawn")
+    port = free_port()
+    handled = ctx.Value("q", 0)
+    bots = [ctx.Process(target=bot_process, args=(i, processes, path, port, handled)) for i in range(processes)]
+    for p in bots:
+        p.start()
+    try:
+        wait_port(port)
+        time.sleep(1)
+        clients = [
+            ctx.Process(target=client_process, args=(flows[i::args.clients], port, args.concurrency))
+            for i in range(args.clients)
+        ]
+        started = time.perf_counter()
+        for p in clients:
+            p.start()
+        for p in clients:
+            p.join()
+        while handled.value < total:
+            if not all(p.is_alive() for p in bots):
+                raise RuntimeError("процесс бота упал")
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - started
+    finally:
+        for p in bots:
+            p.terminate()
+        for p in bots:
+            p.join()
+
+    sold = conn.execute("SELECT key, user_id FROM keys WHERE user_id IS NOT NULL").fetchall()
+    assert len(sold) == len({k for k, _ in sold}), "ключ продан дважды"
+    owned = {}
+    for _, uid in sold:
+        owned[uid] = owned.get(uid, 0) + 1
+    for uid, balance in conn.execute("SELECT telegram_id, balance_kopecks FROM users"):
+        assert balance >= 0, "баланс ушёл в минус"
+        assert balance == db.to_kopecks(BALANCE - PRICE * owned.get(uid, 0)), "списано не столько, сколько куплено"
+    assert not reconcile_ledger.reconcile(conn)[1], "баланс в users разошёлся с журналом"
+    return total, elapsed, len(sold)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--users", type=int, default=400)
+    parser.add_argument("--products", type=int, default=10)
+    parser.add_argument("--clients", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=64)
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    base = None
+    ok = True
+    print(f"{'процессов':>10} {'обновлений':>11} {'обн/с':>9} {'ускорение':>10} {'эффективность':>14} {'продано':>8}")
+    for processes in args.processes:
+        total, elapsed, sold = run(processes, args)
+        rate = total / elapsed
+        base = base or rate / args.processes[0]
+        speedup = rate / base
+        efficiency = speedup / processes
+        print(f"{processes:>10} {total:>11} {rate:>9.1f} {speedup:>10.2f} {efficiency:>14.2f} {sold:>8}")
+        if processes + args.clients <= cores and efficiency < EFFICIENCY:
+            ok = False
+    print("OK: ни один ключ не продан дважды, балансы сходятся с покупками")
+    if max(args.processes) + args.clients > cores:
+        print(f"ядер: {cores} — меньше, чем процессов бота и клиентов, рост не оценивается")
+    elif not ok:
+        print(f"FAIL: эффективность ниже {EFFICIENCY}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
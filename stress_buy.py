@@ -0,0 +1,78 @@
+# Стресс-проверка покупки: много покупателей одновременно разбирают ключи,
+# ни один ключ не должен уйти двоим, ни один баланс не должен уйти в минус.
+# Покупатели берут по 1, 2 или 3 ключа за раз: партия выдаётся целиком или не выдаётся вовсе.
+# Запуск: python stress_buy.py [покупателей] [ключей]
+import os
+import sys
+import tempfile
+import threading
+import db
+import reconcile_ledger
+
+BUYERS = 32
+KEYS = 500
+PRICE = 10
+
+
+def main(buyers=BUYERS, keys=KEYS):
+    tmp = tempfile.mkdtemp()
+    db.DB_PATH = os.path.join(tmp, "stress.db")
+    db.init_db()
+    conn = db.get_conn()
+    conn.execute("INSERT INTO products (name, price) VALUES ('stress', ?)", (PRICE,))
+    conn.executemany("INSERT INTO keys (product_id, key) VALUES (1, ?)", [(f"KEY-{i}",) for i in range(keys)])
+    # Чётным покупателям хватает на пару ключей, нечётным — на весь склад,
+    # так что сработают все три исхода
+    budgets = {1000 + i: PRICE * 2 if i % 2 == 0 else PRICE * keys for i in range(buyers)}
+    conn.executemany("INSERT INTO users (telegram_id) VALUES (?)", [(telegram_id,) for telegram_id in budgets])
+    conn.executemany(
+        "INSERT INTO ledger (user_id, kopecks, kind, created_at) VALUES (?, ?, ?, 0)",
+        [(telegram_id, db.to_kopecks(budget), db.LEDGER_ADJUST) for telegram_id, budget in budgets.items()]
+    )
+    conn.commit()
+
+    results = {}
+    start = threading.Barrier(buyers)
+
+    def buyer(telegram_id):
+        got = []
+        quantity = 1 + telegram_id % 3
+        start.wait()
+        while True:
+            status, keys = db.buy_keys(1, telegram_id, quantity)
+            if status != db.BUY_OK:
+                assert not keys, "при отказе выданы ключи"
+                break
+            assert len(keys) == quantity, "выдана неполная партия"
+            got.extend(keys)
+        results[telegram_id] = (status, got)
+
+    threads = [threading.Thread(target=buyer, args=(1000 + i,)) for i in range(buyers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    sold = [k for _, got in results.values() for k in got]
+    assert len(sold) == len(set(sold)), "ключ продан дважды"
+    rows = conn.execute("SELECT key, user_id FROM keys WHERE user_id IS NOT NULL").fetchall()
+    owners = dict(rows)
+    assert len(rows) == len(sold), "в базе продано не столько ключей, сколько выдано"
+    for telegram_id, (_, got) in results.items():
+        for k in got:
+            assert owners[k] == telegram_id, "ключ записан не на того покупателя"
+    for telegram_id, balance in conn.execute("SELECT telegram_id, balance_kopecks FROM users"):
+        assert balance >= 0, "баланс ушёл в минус"
+        assert balance == db.to_kopecks(budgets[telegram_id] - PRICE * len(results[telegram_id][1])), \
+            "списано не столько, сколько куплено"
+    assert not reconcile_ledger.reconcile(conn)[1], "баланс в users разошёлся с журналом"
+
+    statuses = [s for s, _ in results.values()]
+    print(f"покупателей: {buyers}, ключей: {keys}, продано: {len(sold)}, "
+          f"закончились деньги: {statuses.count(db.BUY_NO_FUNDS)}, "
+          f"закончились ключи: {statuses.count(db.BUY_OUT_OF_STOCK)}")
+    print("OK: ни один ключ не продан дважды")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:3]))
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import signal
+from aiohttp import web
+from aiogram.types import Update
+from config import (
+    WEBHOOK_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET,
+    WEBHOOK_WORKERS,
+    WEBHOOK_QUEUE_SIZE,
+    WEBHOOK_MAX_CONNECTIONS,
+)
+
+# Приём обновлений через вебхук на aiohttp.
+# Запрос только кладёт обновление в ограниченную очередь и сразу отвечает Telegram,
+# обработку ведут WEBHOOK_WORKERS воркеров. Если очередь полна — отвечаем 503,
+# Telegram повторит доставку позже (обратное давление вместо неограниченного роста памяти).
+# При остановке сервер перестаёт принимать запросы и дожидается уже принятых обновлений.
+# Как и при поллинге, вызываются startup/shutdown-хуки диспетчера и закрывается сессия бота.
+
+
+def build_app(dp, bot, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE):
+    app = web.Application()
+    queue = asyncio.Queue(maxsize=queue_size)
+    tasks = []
+
+    async def worker():
+        while True:
+            update = await queue.get()
+            try:
+                await dp.feed_update(bot, update)
+            except Exception:
+                logging.exception("Ошибка обработки обновления %s", update.update_id)
+            finally:
+                queue.task_done()
+
+    async def handle(request):
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": bot})
+        except Exception:
+            return web.Response(status=400)
+        try:
+            queue.put_nowait(update)
+        except asyncio.QueueFull:
+            return web.Response(status=503, headers={"Retry-After": "1"})
+        return web.Response()
+
+    async def on_startup(app):
+        tasks.extend(asyncio.create_task(worker()) for _ in range(workers))
+
+    async def on_shutdown(app):
+        # Новые запросы уже не принимаются — дорабатываем то, что в очереди
+        await queue.join()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    app.router.add_post(WEBHOOK_PATH, handle)
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    app["queue"] = queue
+    return app
+
+
+async def serve(dp, bot, host=WEBHOOK_HOST, port=WEBHOOK_PORT, reuse_port=False, register=True):
+    # reuse_port — несколько процессов слушают один порт (workers.py);
+    # register — регистрирует вебхук в Telegram, при нескольких процессах это делает только первый
+    # Хуки жизненного цикла диспетчера вызываются так же, как в dp.start_polling
+    workflow_data = {"dispatcher": dp, "bots": [bot], **dp.workflow_data}
+    workflow_data.pop("bot", None)
+    await dp.emit_startup(bot=bot, **workflow_data)
+    app = build_app(dp, bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port, reuse_port=reuse_port)
+    await site.start()
+    logging.info("Вебхук слушает %s:%s%s", host, port, WEBHOOK_PATH)
+
+    if WEBHOOK_URL and register:
+        await bot.set_webhook(
+            WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        # Сначала дорабатываем принятые обновления, потом хуки остановки и закрытие сессии бота
+        try:
+            await runner.cleanup()
+            await dp.emit_shutdown(bot=bot, **workflow_data)
+        finally:
+            await bot.session.close()
@@ -0,0 +1,47 @@
+import logging
+import multiprocessing
+import signal
+import time
+
+# Несколько процессов бота над одной базой (режим webhook, PROCESSES > 1).
+# Все процессы слушают один порт через SO_REUSEPORT — ядро само раздаёт им входящие
+# соединения Telegram, отдельный фронт не нужен. Согласованность между процессами держит база:
+# WAL, покупка и подтверждение оплаты в BEGIN IMMEDIATE, баланс меняется атомарными UPDATE,
+# FSM читается из базы без кэша в памяти. Кэш ролей (identity.py) у каждого процесса свой:
+# смена роли в одном процессе видна остальным не позже чем через IDENTITY_TTL.
+# Процессы запускаются через spawn: дочерний процесс не наследует соединения SQLite и потоки родителя.
+# Упавший процесс перезапускается; SIGINT/SIGTERM останавливает все процессы штатно.
+
+RESTART_DELAY = 1
+
+
+def run(target, processes):
+    ctx = multiprocessing.get_context("spawn")
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    def start(index):
+        process = ctx.Process(target=target, args=(index, processes), name=f"bot-{index}")
+        process.start()
+        logging.info("Запущен процесс %s (pid %s)", process.name, process.pid)
+        return process
+
+    children = [start(index) for index in range(processes)]
+    while not stopping:
+        time.sleep(RESTART_DELAY)
+        for index, process in enumerate(children):
+            if not stopping and not process.is_alive():
+                logging.error("Процесс %s завершился с кодом %s, перезапуск", process.name, process.exitcode)
+                children[index] = start(index)
+
+    for process in children:
+        if process.is_alive():
+            process.terminate()
+    for process in children:
+        process.join()